@@ -1,14 +1,57 @@
 from argtools import command, argument
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ast
+import builtins
+import collections
+import collections.abc
+import contextlib
+import cProfile
 import csv
 from datetime import date
 from datetime import datetime
 import difflib
+import functools
+import gzip
+import hashlib
+from html import unescape
+import json
+import logging
 import markdown2
 import math
 import os
+import pickle
 import re
+import shelve
 import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import types
 import yaml
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
 
 
 boilerplate = '''
@@ -88,63 +131,596 @@ boilerplate = '''
 
 eval_globals = dict([(fn, getattr(math, fn)) for fn in dir(math) if not fn.startswith('_')])
 
+# The page's style, which the shared_css option writes to a stylesheet shared by every page
+style_pattern = re.compile(r'<style>\n(.*?)\n\s*</style>', re.S)
+style_sheet = textwrap.dedent(style_pattern.search(boilerplate).group(1)) + '\n'
+style_sheet_name = f'doc_tools.{hashlib.sha1(style_sheet.encode("utf-8")).hexdigest()[:12]}.css'
+
+# The page without the script that renders mermaid diagrams in the browser, for diagrams rendered by the build
+static_boilerplate = re.sub(r'\n\s*<script type="module" defer>.*?</script>', '', boilerplate, flags=re.S)
+
 extras = ['tables', 'strike', 'cuddled-lists', 'fenced-code-blocks',
           'header-ids', 'numbering', 'task-list', 'wiki-tables', 'mermaid']
 
-def log(text, level=0):
-    '''Print log data'''
-    print(text)
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)    # libyaml's loader when it is installed
+yaml_cache = {}
+loading = set()     # yaml files being parsed, to stop files including themselves
+data_cache = {}
+snapshots = {}
+
+markdown_cache = collections.OrderedDict()
+markdown_cache_size = 4096      # most recent markdown conversions kept in memory
+diagram_cache = {}
+diagram_pattern = re.compile(r'<pre class="mermaid-pre"><div class="mermaid">(.*?)</div></pre>', re.S)
+diagram_timeout = 120   # seconds allowed to render a single diagram
+
+options = {
+    'cache_dir': None,      # parsed files are cached here when set
+    'keep_data': False,     # keep the items of each directory in memory between builds
+    'markdown_cache': False, # keep converted markdown on disk as well as in memory
+    'assets': ['.png', '.jpg'], # extensions of the files copied to the destination as they are
+    'copy_assets': False,   # copy assets rather than reflinking or hard linking them
+    'columnar': False,      # hold csv rows as columns rather than a dictionary for each row
+    'profile': False,       # record the time spent in each stage, template and item
+    'mermaid': None,        # command rendering mermaid diagrams to svg during the build, like mmdc
+    'shard': (0, 1),        # (index, count) of the slice of the directories this build renders
+    'destination_dir': None, # root of the build's output, pages are sharded by their path relative to it
+    'search': False,        # write a search index of the words in every page with the pages
+    'compress': False,      # write .gz, and with brotli .br, copies of the pages next to them
+    'shared_css': False     # link the pages to a shared stylesheet rather than including their style
+}
+
+asset_threads = 8
+write_threads = 4
+write_queue = 64            # rendered pages waiting to be written before rendering waits for them
+FICLONE = 0x40049409        # Linux ioctl to clone a file as a reflink
+
+stats = collections.Counter()
+
+def init_worker(values):
+    '''Copy the options of the main process into a worker process.'''
+    options.update(values)
+
+profile_lock = threading.Lock()     # pages are written and assets copied on several threads
 
-def sum(expr):
-    result = 0
-    for item in list:
-        result += eval(expr, data, item)
-    return result
+@contextlib.contextmanager
+def profiled(stage, name=None):
+    '''Add the wall time of the block and a call to the profile of stage and, if given, of name in it.
+
+    Nothing is recorded unless the profile option is set.
+    '''
+    if not options['profile']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with profile_lock:
+            for key in [(stage, None), (stage, name)] if name is not None else [(stage, None)]:
+                stats[('seconds',) + key] += seconds
+                stats[('calls',) + key] += 1
+
+
+def profile_report(top=10):
+    '''Return the lines of a table of the time spent in each stage and in the slowest templates and items.
+
+    Stages nest, templates include the markdown they convert and the build includes everything.
+    '''
+    lines = [f'{"stage":<12} {"calls":>8} {"seconds":>10}']
+    stages = sorted([(key[1], seconds) for key, seconds in stats.items()
+                     if isinstance(key, tuple) and key[0] == 'seconds' and key[2] is None],
+                    key=lambda stage: -stage[1])
+    for stage, seconds in stages:
+        lines.append(f'{stage:<12} {stats[("calls", stage, None)]:>8} {seconds:>10.3f}')
+    for stage, title in [('template', 'Slowest templates'), ('item', 'Slowest items')]:
+        slowest = sorted([(seconds, key[2]) for key, seconds in stats.items()
+                          if isinstance(key, tuple) and key[0] == 'seconds' and key[1] == stage and key[2] is not None],
+                         reverse=True)[:top]
+        if slowest:
+            lines.append(title)
+            for seconds, name in slowest:
+                lines.append(f'{seconds:>10.3f}s {stats[("calls", stage, name)]:>6} calls  {name}')
+    return lines
+
+
+logger = logging.getLogger('process_files')
+
+
+def log_level(args):
+    '''Return the level to log at for the --quiet, --verbose and --debug arguments.'''
+    if args.quiet:
+        return logging.WARNING
+    if args.verbose or args.debug:
+        return logging.DEBUG
+    return logging.INFO
 
 def to_dict(obj):
-    if isinstance(obj, dict):
+    if isinstance(obj, collections.abc.Mapping):
         return obj
     elif isinstance(obj, list):
         return dict([(f'_{i}', obj[i]) for i in range(len(obj))])
     return {'key': obj}
 
-def process(template, item, meta):
-    pattern = re.compile('\{(\S[^\}]*)\}|\[([^:]+):\s*([^\]]+)\]')
-    context = {**eval_globals, **meta}
+def code_names(code):
+    '''Return the names referenced by a code object and the code nested within it.'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+pattern = re.compile(r'\{(\S[^\}]*)\}|\[([^:]+):\s*([^\]]+)\]')
+
+template_cache = {}
+
+# Builtins available to template expressions, anything reaching outside the template is left out
+safe_builtins = dict([(name, getattr(builtins, name)) for name in [
+    'abs', 'all', 'any', 'bool', 'chr', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'format',
+    'int', 'isinstance', 'len', 'list', 'map', 'max', 'min', 'ord', 'range', 'reversed', 'round',
+    'set', 'sorted', 'str', 'sum', 'tuple', 'zip']])
+
+# Attributes that lead from a value to frames, code or the interpreter
+unsafe_attributes = ['format', 'format_map', 'mro']
+unsafe_attribute_prefixes = ('_', 'gi_', 'cr_', 'ag_', 'f_', 'tb_', 'co_')
 
-    def sum(list, expr):
-        result = 0
-        for item in list:
-            result += eval(expr, data, item)
-        return result
-    
-    context['sum'] = sum
 
-    def replace(match):
+def check_expression(tree):
+    '''Raise SyntaxError if a parsed template expression could reach outside of the template.'''
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) \
+            and (node.attr in unsafe_attributes or node.attr.startswith(unsafe_attribute_prefixes)):
+            raise SyntaxError(f'attribute {node.attr} is not allowed in templates')
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise SyntaxError(f'name {node.id} is not allowed in templates')
+        if isinstance(node, ast.NamedExpr):
+            raise SyntaxError('assignment is not allowed in templates')
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expression(source):
+    '''Parse, check and compile a template expression.'''
+    tree = ast.parse(source.strip(), '<template>', 'eval')
+    check_expression(tree)
+    return compile(tree, '<template>', 'eval')
+
+
+placeholder_pattern = re.compile(r'(%(?:TITLE|UPDATED|CONTENT)%)')
+
+
+class Placeholder(str):
+    '''A %NAME% placeholder in the literal text of a template, filled in as the page is joined.'''
+
+
+def split_placeholders(text):
+    '''Split text into literal strings and the Placeholders between them.'''
+    return [Placeholder(part) if index % 2 else part
+            for index, part in enumerate(placeholder_pattern.split(text)) if part]
+
+
+def fill(segments, values):
+    '''Join literal strings and Placeholders, replacing each Placeholder with its value.'''
+    return ''.join([values.get(segment, segment) if isinstance(segment, Placeholder) else segment
+                    for segment in segments])
+
+
+def compile_template(template):
+    '''Split template text into literal strings and (text, source, code, names) expressions.
+
+    source is None for {expr}, '#' for {#expr} and the list source of [source: template]
+    expansions, whose template is compiled as an f-string. Placeholders in the literal text
+    are split out so pages are assembled in a single join.
+    '''
+    chunks = []
+    position = 0
+    for match in pattern.finditer(template):
+        chunks.extend(split_placeholders(template[position:match.start()]))
+        position = match.end()
         try:
             if match.group(2):
-                if match.group(2) == '*':
-                    source = meta['data']
-                elif match.group(2) == '**':
-                    source = item
-                elif match.group(2).startswith('*'):
-                    source = meta[match.group(2)[1:]]
+                source = match.group(2)
+                code = compile_expression(f"f'{match.group(3)}'")
+            else:
+                source = '#' if match.group(1).startswith('#') else None
+                code = compile_expression(match.group(1).removeprefix('#'))
+        except SyntaxError as e:
+            logger.warning('%s', e)
+            chunks.extend(split_placeholders(match.group(0)))
+            continue
+        chunks.append((match.group(0), source, code, code_names(code)))
+    chunks.extend(split_placeholders(template[position:]))
+    return [chunk for chunk in chunks if chunk != '']
+
+
+directive_pattern = re.compile(r'\{(extends|include|block|endblock)(?:\s+([^\s\}]+))?\s*\}')
+layout_cache = {}
+
+
+def parse_layout(template_file):
+    '''Return the layout a template file extends, or None, and its text split at its directives.
+
+    The text is a list of strings, ('include', file) partials and ('block', name, nodes) blocks.
+    Parsed files are cached by modification time so layouts and partials are parsed once for
+    every template that uses them.
+    '''
+    status = file_stat(template_file)
+    if status is None:
+        raise FileNotFoundError(f'{template_file} not found')
+    mtime = status.st_mtime
+    if layout_cache.get(template_file, (None,))[0] == mtime:
+        return layout_cache[template_file][1]
+    with open(template_file) as file:
+        text = file.read()
+    extends = None
+    stack = [[]]
+    position = 0
+    for match in directive_pattern.finditer(text):
+        stack[-1].append(text[position:match.start()])
+        position = match.end()
+        directive, name = match.groups()
+        if directive == 'endblock':
+            if len(stack) == 1:
+                raise SyntaxError(f'{template_file}: endblock without a block')
+            stack.pop()
+        elif name is None:
+            raise SyntaxError(f'{template_file}: {directive} needs a name')
+        elif directive == 'extends':
+            extends = name
+        elif directive == 'include':
+            stack[-1].append(('include', name))
+        else:
+            block = ('block', name, [])
+            stack[-1].append(block)
+            stack.append(block[2])
+    if len(stack) > 1:
+        raise SyntaxError(f'{template_file}: block without an endblock')
+    stack[0].append(text[position:])
+    layout_cache[template_file] = mtime, (extends, stack[0])
+    return extends, stack[0]
+
+
+def expand_layout(template_file, files, stack=(), blocks={}):
+    '''Return the text of a template file with the layouts it extends and the partials it includes.
+
+    A template that extends a layout gives the content of the blocks it defines, which replace
+    the blocks of that name in the layout. The layout and partial files are found relative to
+    the file naming them. Every file read is added to files.
+    '''
+    if template_file in stack:
+        raise SyntaxError(f'{template_file} includes or extends itself')
+    stack += (template_file,)
+    if template_file not in files:
+        files.append(template_file)
+    directory = os.path.dirname(template_file)
+    extends, nodes = parse_layout(template_file)
+
+    own = {}
+    def find_blocks(nodes):
+        for node in nodes:
+            if isinstance(node, tuple) and node[0] == 'block':
+                own.setdefault(node[1], (node[2], directory))
+                find_blocks(node[2])
+    find_blocks(nodes)
+    blocks = {**own, **blocks}     # blocks of the templates extending this one take precedence
+    if extends is not None:
+        return expand_layout(os.path.normpath(os.path.join(directory, extends)), files, stack, blocks)
+
+    def render(nodes, directory):
+        parts = []
+        for node in nodes:
+            if isinstance(node, str):
+                parts.append(node)
+            elif node[0] == 'include':
+                parts.append(expand_layout(os.path.normpath(os.path.join(directory, node[1])), files, stack))
+            else:
+                parts.append(render(*blocks.get(node[1], (node[2], directory))))
+        return ''.join(parts)
+    return render(nodes, directory)
+
+
+def template_dependents(changed):
+    '''Return the directories with pages using templates, layouts or partials in the changed directories.'''
+    templates = set([template_file for template_file, (dependencies, _, _) in template_cache.items()
+                     if any([os.path.dirname(path) in changed for path in dependencies])])
+    return set([directory for directory, used in directory_templates.items() if used & templates])
+
+
+def load_template(template_file):
+    '''Return the hash and compiled form of a template file, compiling it only when it changes.
+
+    A template extending a layout or including partials is recompiled when any of them change
+    and its hash is that of the text they expand to.
+    '''
+    cached = template_cache.get(template_file)
+    if cached is None or any([file_key(path) != key for path, key in cached[0].items()]):
+        files = [template_file]
+        try:
+            template = expand_layout(template_file, files)
+        except (OSError, SyntaxError) as e:
+            logger.warning('%s', e)
+            with open(template_file) as file:
+                template = file.read()
+        dependencies = dict([(path, file_key(path)) for path in files])
+        template_cache[template_file] = (dependencies, content_hash(template), compile_template(template))
+    return template_cache[template_file][1:]
+
+
+def column(items, name):
+    '''Return the values of the column name of items.
+
+    items is either a dictionary of data items, whose content holds the columns, or a list of
+    mappings such as rows from yaml. Missing values are None.
+    '''
+    if isinstance(items, dict):
+        items = [item.get('content') for item in items.values()]
+    return [row.get(name) if isinstance(row, collections.abc.Mapping) else None for row in items]
+
+
+def column_keys(items):
+    '''Return what identifies each row of items: the names of data items, or the rows of a list.'''
+    return list(items.keys()) if isinstance(items, dict) else list(items)
+
+
+def to_number(value):
+    '''Return a csv or yaml value as a number, or None if it is empty.'''
+    if value is None or isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def to_array(numbers):
+    '''Return a list of numbers as a NumPy array, or as it is without NumPy.'''
+    if numpy is None:
+        return numbers
+    if all([isinstance(number, int) for number in numbers]):
+        try:
+            return numpy.array(numbers, dtype=numpy.int64)
+        except OverflowError:
+            return numbers
+    return numpy.array(numbers, dtype=numpy.float64)
+
+
+def total(numbers):
+    '''Return the sum of an array of numbers, an int if they all are.
+
+    Floats are added with math.fsum, which NumPy does not round the same way, so that
+    templates give the same result with and without NumPy.
+    '''
+    if numpy is not None and isinstance(numbers, numpy.ndarray):
+        if numbers.dtype.kind == 'i':
+            return numbers.sum().item()
+        return math.fsum(numbers.tolist())
+    if all([isinstance(number, int) for number in numbers]):
+        return builtins.sum(numbers)
+    return math.fsum(numbers)
+
+
+def mean(numbers):
+    '''Return the mean of an array of numbers, or None if there are none.'''
+    if len(numbers) == 0:
+        return None
+    return total(numbers) / len(numbers)
+
+
+def is_blank(value):
+    '''Return True if a csv or yaml value is missing or only whitespace.'''
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def sort_order(values, reverse=False):
+    '''Return the positions of values in sorted order, keeping ties in order and missing values last.
+
+    Values are compared as numbers if they all are, otherwise as strings.
+    '''
+    present = [index for index, value in enumerate(values) if not is_blank(value)]
+    missing = [index for index, value in enumerate(values) if is_blank(value)]
+    try:
+        keys = [to_number(values[index]) for index in present]
+    except (TypeError, ValueError):
+        keys = [str(values[index]) for index in present]
+    else:
+        if numpy is not None:
+            array = to_array(keys)
+            if isinstance(array, numpy.ndarray):
+                order = numpy.argsort(-array if reverse else array, kind='stable')
+                return [present[index] for index in order.tolist()] + missing
+    order = sorted(range(len(present)), key=lambda index: keys[index], reverse=reverse)
+    return [present[index] for index in order] + missing
+
+
+class Meta(collections.abc.Mapping):
+    '''The meta data of a directory available to templates, each value loaded on first use.
+
+    The globals templates are evaluated in are built once per directory and only hold the
+    meta values their expressions refer to, rather than being copied for every page.
+    '''
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.values = {}
+        self.context = {**eval_globals, '__builtins__': safe_builtins, 'sum': self.sum, 'mean': self.mean,
+                        'count': self.count, 'group_by': self.group_by, 'sort': self.sort}
+        self.data_context = None
+        self.columns = {}
+        self.table = False      # the Table holding all of data, None if there is not one, once looked for
+        self.stubs = False      # whether data holds stubs of streamed csv items
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            self.values[key] = self.loaders[key]()
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.loaders)
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def add_globals(self, names):
+        '''Add the meta values among names to the context, returning the meta keys in names.'''
+        keys = names & self.loaders.keys()
+        for key in keys:
+            if key not in self.context:
+                self.context[key] = self[key]
+        return keys
+
+    def data_globals(self):
+        '''Return a copy of data that list expansions are evaluated in.
+
+        A copy is needed to give expressions the safe builtins.
+        '''
+        if self.data_context is None:
+            self.data_context = {**self['data'], '__builtins__': safe_builtins}
+        return self.data_context
+
+    def column(self, items, name):
+        '''Return the values of a column of items, kept for the columns of data.'''
+        if items is not self.values.get('data'):
+            return column(items, name)
+        if name not in self.columns:
+            if self.table is False:
+                self.table = table_of(items)
+                self.stubs = any(['content' not in item for item in items.values()])
+            if self.table is not None and name in self.table.columns:
+                self.columns[name] = [None if value is absent else value for value in self.table.columns[name]]
+            else:
+                self.columns[name] = column(items, name)
+            if self.stubs:
+                # Streamed csv items only have a stub in data, their rows are read as their pages render
+                logger.warning('%s is missing from the csv items of data with --stream', name)
+        return self.columns[name]
+
+    def numbers(self, items, name):
+        '''Return the numbers in a column of items as an array, kept for the columns of data.
+
+        A warning is logged if none of the items has the column, as the name is likely wrong.
+        '''
+        data = items is self.values.get('data')
+        if data and ('numbers', name) in self.columns:
+            return self.columns[('numbers', name)]
+        values = self.column(items, name) if data else column(items, name)
+        if values and all([value is None for value in values]) and not (data and self.stubs):
+            logger.warning('%s is not a column of any of the items', name)
+        numbers = to_array([number for number in map(to_number, values) if number is not None])
+        if data:
+            self.columns[('numbers', name)] = numbers
+        return numbers
+
+    def sum(self, items, expr=None):
+        '''Template helper returning a total.
+
+        For a dictionary of data items expr names the column to add up, for a list expr is
+        evaluated for each item and without expr the items themselves are added.
+        '''
+        if isinstance(items, dict) and expr is not None:
+            return total(self.numbers(items, expr))
+        if expr is None:
+            return builtins.sum(items)
+        code = compile_expression(expr)
+        names = self.data_globals()
+        return builtins.sum([eval(code, names, to_dict(item)) for item in items])
+
+    def mean(self, items, name):
+        '''Template helper returning the mean of the numbers in a column of items.'''
+        return mean(self.numbers(items, name))
+
+    def count(self, items, name=None, value=None):
+        '''Template helper counting items, those with a value in a column or those where it equals value.'''
+        if name is None:
+            return len(items)
+        values = self.column(items, name)
+        if value is None:
+            return len([value for value in values if not is_blank(value)])
+        return values.count(value)
+
+    def group_by(self, items, name):
+        '''Template helper returning the names of data items, or the rows of a list, by their value in a column.'''
+        groups = {}
+        for key, value in zip(column_keys(items), self.column(items, name)):
+            groups.setdefault(value, []).append(key)
+        return groups
+
+    def sort(self, items, name, reverse=False):
+        '''Template helper returning the names of data items, or the rows of a list, sorted by a column.'''
+        keys = column_keys(items)
+        return [keys[index] for index in sort_order(self.column(items, name), reverse)]
+
+
+def process(template, item, meta, used=None, values=None):
+    '''Expand the template for item, adding the meta keys it reads to used.
+
+    template is either the text of a template or the chunks returned by compile_template.
+    Placeholders in its text are replaced by their values, when given, in the same pass.
+    '''
+    if isinstance(template, str):
+        template = compile_template(template)
+    if used is None:
+        used = set()
+    if not isinstance(meta, Meta):
+        meta = Meta(dict([(key, lambda value=value: value) for key, value in meta.items()]))
+    context = meta.context
+
+    def expand(text, source, code, names):
+        if source is None:
+            used.update(meta.add_globals(names))
+            return str(eval(code, context, item))
+        if source == '#':
+            used.update(meta.add_globals(names))
+            return render_markdown(str(eval(code, context, item)))
+        if source == '*':
+            used.add('data')
+            source = meta['data']
+        elif source == '**':
+            source = item
+        elif source.startswith('*'):
+            used.add(source[1:])
+            source = meta[source[1:]]
+        else:
+            source = item[source]
+        # Expansions are evaluated among the items of data, so only depend on it if they read one
+        if names & meta['data'].keys():
+            used.add('data')
+        names = meta.data_globals()
+        if isinstance(source, list) or isinstance(source, set):
+            return '\n'.join([str(eval(code, names, to_dict(item))) for item in source])
+        if isinstance(source, collections.abc.Mapping):
+            result = []
+            try:
+                for key in source:
+                    names['key'] = key
+                    result.append(str(eval(code, names, item)))
+            finally:
+                if 'key' in meta['data']:
+                    names['key'] = meta['data']['key']
                 else:
-                    source = item[match.group(2)]
-                template = match.group(3)
-                if isinstance(source, list) or isinstance(source, set):
-                    return '\n'.join([str(eval(f"f'{template}'", meta['data'], to_dict(item))) for item in source])
-                if isinstance(source, dict):
-                    return '\n'.join([str(eval(f"f'{template}'", {**meta['data'], **{'key': key}}, item)) for key in source])
-            element = str(match.group(1))
-            if element.startswith('#'):
-                processed = str(eval(element[1:], context, item))
-                return markdown2.markdown(processed, extras=extras)
-            return str(eval(element, context, item))
+                    names.pop('key', None)
+            return '\n'.join(result)
+        return 'None'   # Only lists, sets and dictionaries expand
+
+    result = []
+    for chunk in template:
+        if isinstance(chunk, str):
+            if values is not None and isinstance(chunk, Placeholder):
+                chunk = values.get(chunk, chunk)
+            result.append(chunk)
+            continue
+        try:
+            text = expand(*chunk)
         except Exception as e:
-            print(e)
-            return match.group(0)
-    return pattern.sub(replace, template)
+            logger.warning('%s', e)
+            text = chunk[0]
+        if values is not None and '%' in chunk[0]:
+            # Placeholders in an expansion's template are repeated in its output
+            text = placeholder_pattern.sub(lambda match: values.get(match.group(0), match.group(0)), text)
+        result.append(text)
+    return ''.join(result)
 
 
 def fix_name(name):
@@ -155,151 +731,1370 @@ def fix_name(name):
     return name.strip()
 
 
-def process_dir(source, destination, force):
-    '''Recursively process all the files in the directory.'''
+manifest_name = '.doc_tools_manifest'
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'doc_tools')
+manifest_version = 1
+
+search_index_name = 'search.json.gz'
+search_script_name = 'search.js'
+search_word_length = 32     # longer words are left out of the search index
+split_size = 1 << 20     # data bytes in a directory before its pages are spread over several jobs
+
+
+def json_default(value):
+    '''Serialise the values json does not handle when hashing build inputs.'''
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    return str(value)
+
+
+def content_hash(value):
+    '''Return the hash the build manifest records for an input.'''
+    if not isinstance(value, str):
+        value = json.dumps(value, default=json_default)
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def manifest_file(destination_dir, shard=(0, 1)):
+    '''Return the manifest of a build, each shard of a sharded build having its own.'''
+    index, count = shard
+    return os.path.join(destination_dir, manifest_name if count <= 1 else f'{manifest_name}.{index}-{count}')
+
+
+def load_manifest(destination_dir, shard=(0, 1)):
+    '''Load the inputs recorded for every output by the previous build.
+
+    A shard without a manifest of its own, or with one older than the manifest of a whole build,
+    starts from the manifest of the whole build.
+    '''
+    def modified(filename):
+        try:
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return 0
+    filenames = [manifest_file(destination_dir, shard), manifest_file(destination_dir)]
+    for filename in sorted(filenames, key=modified, reverse=True):
+        try:
+            with open(filename) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == manifest_version:
+                return manifest
+        except (OSError, ValueError):
+            pass
+    return {'version': manifest_version, 'outputs': {}}
+
+
+def save_manifest(destination_dir, manifest, shard=(0, 1)):
+    '''Atomically write the build manifest.'''
+    filename = manifest_file(destination_dir, shard)
+    os.makedirs(destination_dir, exist_ok=True)     # a shard may own none of the directories
+    with open(f'{filename}.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def snapshot(path):
+    '''Return the os.DirEntry of each entry in a directory, by name, from a single os.scandir pass.
+
+    The entries cache their stat, so each file is stat'ed at most once until clear_snapshots
+    is called at the start of the next build.
+    '''
+    if path not in snapshots:
+        try:
+            with os.scandir(path) as scan:
+                snapshots[path] = dict([(entry.name, entry) for entry in scan])
+        except (FileNotFoundError, NotADirectoryError):
+            snapshots[path] = {}
+    return snapshots[path]
+
+
+def clear_snapshots():
+    '''Forget the directory snapshots so that the next build sees the current files.'''
+    snapshots.clear()
+
+
+def file_entry(path):
+    '''Return the entry for a file from the snapshot of its directory, or None if it does not exist.'''
+    path = os.path.abspath(path)
+    return snapshot(os.path.dirname(path)).get(os.path.basename(path))
+
+
+def file_stat(path):
+    '''Return the stat of a file from the snapshot of its directory, or None if it does not exist.'''
+    entry = file_entry(path)
+    try:
+        return entry and entry.stat()
+    except OSError:
+        return None
+
+
+def is_dir(entry):
+    '''Return True if an entry from a snapshot is a directory.'''
+    try:
+        return entry is not None and entry.is_dir()
+    except OSError:
+        return False
+
+
+def in_part(key, part):
+    '''Return True if key belongs to the (index, count) partition of the work.'''
+    index, count = part
+    return count <= 1 or zlib.crc32(key.encode('utf-8')) % count == index
+
+
+def in_shard(destination, name):
+    '''Return True if the output name in the destination directory belongs to the shard being built.
+
+    Outputs are sharded by a hash of their path relative to the root of the build, so every
+    node of a sharded build agrees on where each page goes without talking to the others.
+    '''
+    if options['shard'][1] <= 1:
+        return True
+    return in_part(os.path.relpath(os.path.join(destination, name), options['destination_dir']), options['shard'])
+
+
+def directory_shard(source, destination):
+    '''Return True if the shard being built renders the whole directory, False if another shard does.
+
+    Directories are sharded whole, by a hash of their path relative to the root of the build, so
+    a node never reads the data of directories it does not render. Only the pages of directories
+    with more data than split_size are spread over the shards, in which case None is returned.
+    '''
+    index, count = options['shard']
+    if count <= 1:
+        return True
+    if job_parts(source, count) > 1:
+        return None
+    return in_part(os.path.relpath(destination, options['destination_dir']), options['shard'])
+
 
+def directory_tree(source_dir, destination_dir):
+    '''Return the nested dictionary of sub directories below source_dir.'''
+    tree = {}
+    for directory, entry in snapshot(source_dir).items():
+        path = os.path.join(source_dir, directory)
+        if is_dir(entry) and path not in [destination_dir, options['cache_dir']]:
+            tree[directory] = directory_tree(path, os.path.join(destination_dir, directory))
+    return tree
+
+
+def walk_tree(source_dir, destination_dir, tree):
+    '''Yield (source, destination, tree) for every directory, children before their parents.'''
+    for directory, subtree in tree.items():
+        yield from walk_tree(os.path.join(source_dir, directory), os.path.join(destination_dir, directory), subtree)
+    yield source_dir, destination_dir, tree
+
+
+def job_parts(source_dir, jobs):
+    '''Return the number of jobs the pages of a directory should be split between.'''
+    size = 0
+    for filename in snapshot(source_dir):
+        if os.path.splitext(filename)[1] in ['.csv', '.yaml']:
+            size += file_stat(os.path.join(source_dir, filename)).st_size
+    return min(jobs, 1 + size // split_size)
+
+
+def process_dir(source, destination, force, jobs=1, stream=False, changed=None):
+    '''Recursively process all the files in the directory.
+
+    When changed is given only those source directories are rendered.
+    '''
+
+    start = time.perf_counter()
     source_dir = os.path.abspath(source)
     destination_dir = os.path.abspath(destination)
-    log (f'Processing directory {source_dir}')
+    stats.clear()
+    clear_snapshots()
+    with profiled('list'):
+        tree = directory_tree(source_dir, destination_dir)
+        directories = [(os.path.relpath(output_path, destination_dir), path, output_path, subtree)
+                       for path, output_path, subtree in walk_tree(source_dir, destination_dir, tree)]
 
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
-        log(f'make dir {destination_dir}')
-        
-    filenames = [filename for filename in os.listdir(source_dir)]
-    directories = [file for file in filenames if os.path.isdir(os.path.join(source_dir, file))]
-    image_files = [file for file in filenames if os.path.splitext(file)[1].lower() in ['.png', '.jpg']]
-    template_files = dict([(os.path.join(source_dir, name), set()) for name in filenames
-                            if os.path.splitext(name)[1].lower() in ['.md', '.html']])
+    options['destination_dir'] = destination_dir
+    directories = [directory for directory in directories if directory_shard(directory[1], directory[2]) is not False]
 
-    filenames.sort(key=lambda x: os.path.getmtime(os.path.join(source_dir, x)))
-    content = [os.path.splitext(filename) for filename in filenames]
-    yaml_files = [file for file in content if file[1] == '.yaml']
-    csv_files = [file for file in content if file[1] == '.csv']
-    markdown_files = [file for file in content if file[1] == '.md']
+    # The manifest records, per destination directory, the hash of every input each page read
+    manifest = load_manifest(destination_dir, options['shard'])
+    previous = manifest['outputs']
+    outputs = manifest['outputs'] = {}
+    if changed is not None:
+        changed = set(changed) | yaml_dependents(changed) | template_dependents(changed)
+        outputs.update([(key, previous[key]) for key, path, _, _ in directories if path not in changed and key in previous])
+        directories = [directory for directory in directories if directory[1] in changed]
 
-    tree = {}
-    for directory in directories:
-        if os.path.join(source_dir, directory) != destination_dir:
-           tree[directory] = process_dir(os.path.join(source_dir, directory), os.path.join(destination_dir, directory), force)
-    
-    # Read data from csv and yaml files
+    if jobs <= 1:
+        for key, path, output_path, subtree in directories:
+            outputs[key] = render_dir(path, output_path, force, subtree, previous.get(key, {}), stream=stream)
+    else:
+        # Every directory (or slice of a large directory) renders independently as its tree is already known
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(options,)) as pool:
+            futures = [(key, pool.submit(render_job, path, output_path, force, subtree,
+                                         previous.get(key, {}), (index, parts), stream))
+                       for key, path, output_path, subtree in directories
+                       for parts in [job_parts(path, jobs)]
+                       for index in range(parts)]
+            for key, future in futures:
+                result, counts = future.result()
+                outputs.setdefault(key, {}).update(result)
+                stats.update(counts)
+
+    save_manifest(destination_dir, manifest, options['shard'])
+    if options['search'] and options['shard'][1] <= 1:     # a sharded build's index is written by the merge
+        write_search_index(destination_dir, outputs)
+    if options['shared_css'] and options['shard'][0] == 0:
+        write_page(os.path.join(destination_dir, style_sheet_name), style_sheet)
+    if options['profile']:
+        stats[('seconds', 'build', None)] += time.perf_counter() - start
+        stats[('calls', 'build', None)] += 1
+    logger.info('Pages: %d written, %d unchanged, %d skipped as up to date',
+                stats['pages written'], stats['pages unchanged'], stats['pages skipped'])
+    if any([key.startswith('assets ') for key in stats if isinstance(key, str)]):
+        logger.info('Assets: %d copied, %d reflinked, %d hard linked, %d up to date', stats['assets copy'],
+                    stats['assets reflink'], stats['assets hardlink'], stats['assets up to date'])
+    logger.info('YAML cache: %d hits, %d misses', stats['yaml cache hits'], stats['yaml cache misses'])
+    if stats['diagrams rendered'] or stats['diagram cache hits']:
+        logger.info('Mermaid diagrams: %d rendered, %d cached', stats['diagrams rendered'], stats['diagram cache hits'])
+    conversions = stats['markdown cache hits'] + stats['markdown disk cache hits'] + stats['markdown cache misses']
+    if conversions:
+        logger.info('Markdown cache: %d hits, %d disk hits, %d misses (%.0f%% hit rate)',
+                    stats['markdown cache hits'], stats['markdown disk cache hits'], stats['markdown cache misses'],
+                    100 * (1 - stats['markdown cache misses'] / conversions))
+    return tree
+
+
+def build_shard(values, source, destination, force, jobs, stream):
+    '''Build one shard in a process of its own for build_shards.'''
+    options.update(values)
+    process_dir(source, destination, force, jobs, stream)
+
+
+def build_shards(source, destination, force, count, jobs=1, stream=False):
+    '''Build count shards in local processes, as the nodes of a sharded build would, then merge them.'''
+    with ProcessPoolExecutor(count) as pool:
+        futures = [pool.submit(build_shard, {**options, 'shard': (index, count)}, source, destination, force, jobs, stream)
+                   for index in range(count)]
+        for future in futures:
+            future.result()
+    merge_shards(destination, [destination], count)
+
+
+def merge_shards(destination, shard_dirs, count):
+    '''Combine the outputs of the count shards of a build in destination.
+
+    The pages and assets of shards built into other directories, on other nodes, are copied in
+    along with their manifests. The manifests of the shards are then merged into the manifest
+    of the whole build and removed, so they can not go out of date. Every shard lists the whole source tree, so the tree meta data and
+    index pages rendered by each shard are already complete.
+    '''
+    destination_dir = os.path.abspath(destination)
+    os.makedirs(destination_dir, exist_ok=True)
+    for shard_dir in [os.path.abspath(shard_dir) for shard_dir in shard_dirs]:
+        if shard_dir != destination_dir:
+            shutil.copytree(shard_dir, destination_dir, dirs_exist_ok=True)
+    manifest = {'version': manifest_version, 'outputs': {}}
+    for index in range(count):
+        shard_manifest = load_manifest(destination_dir, (index, count))
+        if not os.path.exists(manifest_file(destination_dir, (index, count))):
+            logger.warning('No manifest for shard %d of %d', index, count)
+            continue
+        for key, pages in shard_manifest['outputs'].items():
+            manifest['outputs'].setdefault(key, {}).update(pages)
+    save_manifest(destination_dir, manifest)
+    for index in range(count):
+        try:
+            os.remove(manifest_file(destination_dir, (index, count)))
+        except OSError:
+            pass
+    if any(['words' in inputs for pages in manifest['outputs'].values() for inputs in pages.values()]):
+        write_search_index(destination_dir, manifest['outputs'])
+    logger.info('Merged %d shards into %s', count, destination_dir)
+
+
+search_script = r'''// Site search over the index process_files --search writes next to this script.
+// Include it with <script src="(path to the root)/search.js"></script> in a page that has
+// <input id="search"> and <ul id="search-results"></ul>, or call siteSearch(query) directly.
+(function() {
+    const base = new URL('.', document.currentScript.src);
+    let index = null;
+
+    async function load() {
+        if (!index) {
+            const response = await fetch(new URL('search.json.gz', base));
+            index = await new Response(response.body.pipeThrough(new DecompressionStream('gzip'))).json();
+        }
+        return index;
+    }
+
+    function collect(node, words) {
+        for (const key in node) {
+            if (key === '$') {
+                words.push(node[key]);
+            } else {
+                collect(node[key], words);
+            }
+        }
+    }
+
+    // Return the urls of the pages with a word starting with each word of the query
+    async function search(query) {
+        const index = await load();
+        let pages = null;
+        for (const term of query.toLowerCase().match(/[\p{L}\p{N}_]{2,}/gu) || []) {
+            let node = index.trie;
+            for (const character of term) {
+                node = node && node[character];
+            }
+            const words = [];
+            if (node) {
+                collect(node, words);
+            }
+            const found = new Set();
+            for (const word of words) {
+                for (const page of index.postings[word]) {
+                    found.add(page);
+                }
+            }
+            pages = pages === null ? found : new Set([...pages].filter(page => found.has(page)));
+        }
+        return [...(pages || [])].map(page => new URL(index.pages[page], base).href);
+    }
+    window.siteSearch = search;
+
+    document.addEventListener('DOMContentLoaded', () => {
+        const input = document.getElementById('search');
+        const results = document.getElementById('search-results');
+        if (!input || !results) {
+            return;
+        }
+        input.addEventListener('input', async () => {
+            const urls = await search(input.value);
+            results.innerHTML = '';
+            for (const url of urls.slice(0, 100)) {
+                const item = document.createElement('li');
+                const link = document.createElement('a');
+                link.href = url;
+                link.textContent = decodeURI(url.slice(base.href.length));
+                item.appendChild(link);
+                results.appendChild(item);
+            }
+        });
+    });
+})();
+'''
+
+
+def page_words(text):
+    '''Return the sorted distinct words in the text of an html page, for the search index.'''
+    text = re.sub(r'<(script|style)\b.*?</\1>', ' ', text, flags=re.S | re.I)
+    text = unescape(re.sub(r'<[^>]*>', ' ', text)).lower()
+    return sorted(set([word for word in re.findall(r'\w{2,}', text) if len(word) <= search_word_length]))
+
+
+def search_index(outputs):
+    '''Return the inverted index and prefix trie of the words the manifest outputs record for each page.
+
+    Pages are numbered by their position in the list of their paths and each word by its
+    position in postings, the list of the pages holding each word. The trie maps the
+    characters of every word to a node whose '$' key is the number of the word.
+    '''
+    pages = []
+    postings = {}
+    for key in sorted(outputs):
+        for page, inputs in sorted(outputs[key].items()):
+            if 'words' not in inputs:
+                continue
+            pages.append(os.path.normpath(os.path.join(key, page)).replace(os.sep, '/'))
+            for word in inputs['words']:
+                postings.setdefault(word, []).append(len(pages) - 1)
+
+    words = sorted(postings)
+    trie = {}
+    for number, word in enumerate(words):
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node['$'] = number
+    return {'pages': pages, 'postings': [postings[word] for word in words], 'trie': trie}
+
+
+def write_search_index(destination_dir, outputs):
+    '''Write the compressed search index of the pages in outputs and its client script to destination_dir.'''
+    text = json.dumps(search_index(outputs), separators=(',', ':'), ensure_ascii=False)
+    compressed = gzip.compress(text.encode('utf-8'), mtime=0)
+    filename = os.path.join(destination_dir, search_index_name)
+    try:
+        with open(filename, 'rb') as file:
+            unchanged = file.read() == compressed
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        with open(f'{filename}.tmp', 'wb') as file:
+            file.write(compressed)
+        os.replace(f'{filename}.tmp', filename)
+        logger.debug('Updating %s', filename)
+    write_page(os.path.join(destination_dir, search_script_name), search_script)
+
+
+def read_csv(fullname):
+    '''Yield (name, header, row) for each row of a csv file, the first row giving the property names.'''
+    with open(fullname) as csv_file:
+        header = None
+        for row in csv.reader(csv_file):
+            if not row:
+                continue
+            if header:
+                yield row[0].replace('/', '_').replace(':', '_'), header, row
+            else:
+                header = [fix_name(item) for item in row]
+
+
+def merge_row(content, header, row):
+    '''Merge a csv row into the content of an item, appending to the values it already has.'''
+    values = {}
+    for key, value in zip(header, row):    # Allow for Jira's habbit of repeating header for list fields
+        values.setdefault(key, []).append(value)
+    for key, value in values.items():
+        value = '\n\n'.join(value)
+        content[key] = f'{content[key]}\n\n{value}' if key in content else value
+
+
+absent = object()    # marks the columns a csv row has no value for
+interned_length = 64 # csv values up to this long are shared between rows
+
+
+class Table:
+    '''The rows of a csv file, held as a list of values for each column.'''
+
+    def __init__(self, header):
+        self.columns = dict([(sys.intern(name), []) for name in header])
+        self.size = 0
+
+    def append(self):
+        '''Add an empty row and return a view of it.'''
+        for values in self.columns.values():
+            values.append(absent)
+        self.size += 1
+        return Row(self, self.size - 1)
+
+
+def table_of(items):
+    '''Return the Table holding the content of every one of a dictionary of data items, in order, or None.
+
+    The columns of such a table can be read directly rather than through each row.
+    '''
+    table = None
+    for index, item in enumerate(items.values()):
+        content = item.get('content')
+        if type(content) is not Row or content.index != index or (table is not None and content.table is not table):
+            return None
+        table = content.table
+    return table if table is not None and table.size == len(items) else None
+
+
+class Row(collections.abc.MutableMapping):
+    '''The content of an item read from a Table, keeping any keys the table lacks to itself.'''
+    __slots__ = ('table', 'index', 'extra')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.extra = None
+
+    def __getitem__(self, key):
+        values = self.table.columns.get(key)
+        if values is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        value = values[self.index]
+        if value is absent:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        values = self.table.columns.get(key)
+        if values is not None:
+            if isinstance(value, str) and len(value) <= interned_length:
+                value = sys.intern(value)   # share the statuses, names and blanks repeated down a column
+            values[self.index] = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        values = self.table.columns.get(key)
+        if values is None:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+        elif values[self.index] is absent:
+            raise KeyError(key)
+        else:
+            values[self.index] = absent
+
+    def __iter__(self):
+        for key, values in self.table.columns.items():
+            if values[self.index] is not absent:
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def cache_file(kind, key):
+    '''Return the file in the on disk cache for key, or None if there is no cache.'''
+    if options['cache_dir'] is None:
+        return None
+    return os.path.join(options['cache_dir'], kind, f'{content_hash(key)}.pickle')
+
+
+def read_cache(filename):
+    '''Return the object pickled in a cache file or None.'''
+    try:
+        with open(filename, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+        return None
+
+
+def write_cache(filename, value):
+    '''Pickle value into a cache file.'''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(filename), delete=False) as file:
+        pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(file.name, filename)
+
+
+class IncludeLoader(yaml_loader):
+    '''The yaml loader with an !include tag, recording the files it includes.'''
+
+    def __init__(self, stream, filename, includes):
+        super().__init__(stream)
+        self.filename = filename
+        self.includes = includes
+
+
+def construct_include(loader, node):
+    '''Return the data of the yaml file named by an !include tag, relative to the including file.
+
+    A file holding a single document gives its data, one with several gives a list of them.
+    '''
+    path = os.path.normpath(os.path.join(os.path.dirname(loader.filename), loader.construct_scalar(node)))
+    if path in loading:
+        raise yaml.constructor.ConstructorError(None, None, f'{path} includes itself', node.start_mark)
+    documents = read_yaml(path)
+    if documents is None:
+        raise yaml.constructor.ConstructorError(None, None, f'can not include {path}', node.start_mark)
+    loader.includes.append(path)
+    loader.includes.extend([include for include in yaml_cache[path][2] if include not in loader.includes])
+    return documents[0] if len(documents) == 1 else documents
+
+IncludeLoader.add_constructor('!include', construct_include)
+
+
+def file_key(path):
+    '''Return what identifies the version of a file, its path, size and modification time.'''
+    status = file_stat(path)
+    return status and (path, status.st_size, status.st_mtime_ns)
+
+
+def read_yaml(fullname):
+    '''Return the list of documents in a yaml file or None if it can not be parsed.
+
+    Parsed files are cached in memory and on disk, keyed by the path, size and modification time
+    of the file and of every file it includes.
+    '''
+    if file_stat(fullname) is None:
+        logger.warning('%s not found', fullname)
+        return None
+    cached = yaml_cache.get(fullname)
+    if cached and [file_key(path) for path in [fullname] + cached[2]] == cached[0]:
+        stats['yaml cache hits'] += 1
+        return cached[1]
+
+    filename = cache_file('yaml', fullname)
+    cached = filename and read_cache(filename)
+    if cached and len(cached) == 3 and [file_key(path) for path in [fullname] + cached[2]] == cached[0]:
+        stats['yaml cache hits'] += 1
+        key, documents, includes = cached
+    else:
+        stats['yaml cache misses'] += 1
+        includes = []
+        loading.add(fullname)
+        with open(fullname) as stream:
+            # Documents are parsed one at a time as yaml.load_all does
+            loader = IncludeLoader(stream, fullname, includes)
+            try:
+                documents = []
+                with profiled('yaml', fullname):
+                    while loader.check_data():
+                        documents.append(loader.get_data())
+            except yaml.YAMLError as exc:
+                logger.warning('%s', exc)
+                return None
+            finally:
+                loader.dispose()
+                loading.discard(fullname)
+        key = [file_key(path) for path in [fullname] + includes]
+        if filename:
+            write_cache(filename, (key, documents, includes))
+    yaml_cache[fullname] = key, documents, includes
+    return documents
+
+
+def yaml_documents(fullname, name):
+    '''Return (name, data, template) for the items in the yaml file fullname called name.
+
+    A file holding a single document is a single item. Each mapping in a stream of several
+    documents is an item of its own, named by its name key or its position in the stream and
+    using the template with the name of the file unless it has a template key.
+    '''
+    documents = read_yaml(fullname)
+    if not documents:
+        return []
+    if len(documents) == 1:
+        return [(name, documents[0], None)] if documents[0] is not None else []
+    template = os.path.join(os.path.dirname(fullname), f'{name}.html')
+    items = []
+    for index, document in enumerate(documents):
+        if isinstance(document, dict):
+            item_name = str(document.get('name', f'{name}_{index}')).replace('/', '_').replace(':', '_')
+            items.append((item_name, document, template))
+    return items
+
+
+def yaml_items(source_dir, yaml_files):
+    '''Yield (fullname, name, data, template) for the items in the yaml files of a directory.
+
+    Files included by another yaml file of the directory only hold data to include, so they are
+    not items themselves.
+    '''
+    files = [(os.path.join(source_dir, f'{filename}{extension}'), filename) for filename, extension in yaml_files]
+    documents = [(fullname, yaml_documents(fullname, filename)) for fullname, filename in files]
+    included = set([include for fullname, _ in files for include in yaml_cache.get(fullname, (None, None, []))[2]])
+    for fullname, items in documents:
+        if fullname not in included:
+            for name, data, template in items:
+                yield fullname, name, data, template
+
+
+def yaml_dependents(changed):
+    '''Return the directories of the yaml files that include files in the changed directories.'''
+    return set([os.path.dirname(fullname) for fullname, (key, documents, includes) in yaml_cache.items()
+                if any([os.path.dirname(include) in changed for include in includes])])
+
+
+def render_markdown(text):
+    '''Convert markdown to html, caching the result by a hash of the text and the extras used.
+
+    The most recently used results are kept in memory and, with the markdown_cache option,
+    every result is also kept on disk.
+    '''
+    key = content_hash([text, extras, options['mermaid'] is not None])
+    if key in markdown_cache:
+        markdown_cache.move_to_end(key)
+        stats['markdown cache hits'] += 1
+        return markdown_cache[key]
+
+    filename = cache_file('markdown', key) if options['markdown_cache'] else None
+    html = read_cache(filename) if filename else None
+    if html is not None:
+        stats['markdown disk cache hits'] += 1
+    else:
+        stats['markdown cache misses'] += 1
+        with profiled('markdown'):
+            html = markdown2.markdown(text, extras=extras)
+        failures = stats['diagram failures']
+        if options['mermaid']:
+            html = diagram_pattern.sub(lambda match: render_diagram(match.group(0), match.group(1)), html)
+        if stats['diagram failures'] != failures:
+            return html     # failed diagrams are tried again the next time they are converted
+        if filename:
+            write_cache(filename, html)
+
+    markdown_cache[key] = html
+    if len(markdown_cache) > markdown_cache_size:
+        markdown_cache.popitem(last=False)
+    return html
+
+
+def render_diagram(block, source):
+    '''Return the svg of the mermaid diagram in source, or block as it is if it can not be rendered.
+
+    Diagrams are rendered by the mermaid option's command and cached, in memory and on disk,
+    by a hash of their source.
+    '''
+    source = unescape(source)
+    key = content_hash(source)
+    if key in diagram_cache:
+        stats['diagram cache hits'] += 1
+        return diagram_cache[key]
+
+    filename = cache_file('mermaid', key)
+    svg = read_cache(filename) if filename else None
+    if svg is None:
+        stats['diagrams rendered'] += 1
+        with profiled('mermaid'), tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'diagram.mmd')
+            output_file = os.path.join(directory, 'diagram.svg')
+            with open(input_file, 'w') as file:
+                file.write(source)
+            try:
+                subprocess.run([options['mermaid'], '-i', input_file, '-o', output_file], check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=diagram_timeout)
+                with open(output_file) as file:
+                    svg = re.sub(r'^\s*<\?xml[^>]*>\s*', '', file.read())
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning('Can not render mermaid diagram: %s', getattr(e, 'stderr', None) or e)
+                stats['diagram failures'] += 1
+                return block
+        if filename:
+            write_cache(filename, svg)
+    else:
+        stats['diagram cache hits'] += 1
+    diagram_cache[key] = svg = f'<div class="mermaid-svg">{svg}</div>'
+    return svg
+
+
+def merge_yaml(data, name, yaml_data, mtime, template=None):
+    '''Merge yaml data into the item called name, overwriting data from csv.
+
+    A new item without a template key uses template when it is given.
+    '''
+    if name not in data:
+        data[name] = { 'content': dict([(fix_name(key), yaml_data[key]) for key in yaml_data]) }
+        if 'template' in yaml_data:
+            data[name]['template'] = yaml_data['template']
+        elif template:
+            data[name]['template'] = template
+    else:
+        for key in yaml_data:
+            data[name]['content'][fix_name(key)] = yaml_data[key]
+    if 'Title' not in yaml_data:
+        data[name]['Title'] = name
+    data[name]['modification_time'] = mtime
+
+
+def load_data(source_dir, csv_files, yaml_files):
+    '''Return the items of a directory.
+
+    With the keep_data option the items are kept in memory until one of the files changes.
+    '''
+    if not options['keep_data']:
+        return read_data(source_dir, csv_files, yaml_files)
+    key = []
+    for filename, extension in csv_files + yaml_files:
+        status = file_stat(os.path.join(source_dir, f'{filename}{extension}'))
+        key.append((filename, extension, status.st_size, status.st_mtime_ns))
+    for filename, extension in yaml_files:
+        cached = yaml_cache.get(os.path.join(source_dir, f'{filename}{extension}'))
+        if cached:
+            key.extend([file_key(path) for path in cached[2]])   # files it includes
+    if data_cache.get(source_dir, (None,))[0] != key:
+        data_cache[source_dir] = key, read_data(source_dir, csv_files, yaml_files)
+    return data_cache[source_dir][1]
+
+
+def read_data(source_dir, csv_files, yaml_files):
+    '''Read the items of a directory from its csv and yaml files.'''
     data = {}
     # Use the first row as the property names, generate a single entry for each subsequent row of the csv
     for filename, extension in csv_files:
         fullname = os.path.join(source_dir, f'{filename}{extension}')
-        mtime = os.path.getmtime(fullname)
-        with open(fullname) as csv_file:
-            header = None
-            for row in csv.reader(csv_file):
-                if header:
-                    name = row[0].replace('/', '_').replace(':', '_')
-                    if name not in data:
-                        data[name] = { 'template': os.path.join(source_dir, f'{filename}.html'), 'content': {} }
-                    data[name]['modification_time'] = mtime
-                    content = data[name]['content']
-                    for i in range(len(header)):    # Allow for Jira's habbit of repeating header for list fields
-                        if header[i] in content:
-                            content[header[i]] += f'\n\n{row[i]}'
-                        else:
-                            content[header[i]] = row[i]
-                else:
-                    header = [fix_name(item) for item in row]
+        mtime = file_stat(fullname).st_mtime
+        table = None
+        with profiled('csv', fullname):
+            for name, header, row in read_csv(fullname):
+                if name not in data:
+                    if options['columnar'] and table is None:
+                        table = Table(header)
+                    content = table.append() if table is not None else {}
+                    data[name] = { 'template': os.path.join(source_dir, f'{filename}.html'), 'content': content }
+                data[name]['modification_time'] = mtime
+                merge_row(data[name]['content'], header, row)
 
     # Process YAML files overwriting data from csv if item names match
-    for name, extension in yaml_files:
-        fullname = os.path.join(source_dir, f'{name}{extension}')
-        with open(fullname) as stream:
+    for fullname, name, yaml_data, template in yaml_items(source_dir, yaml_files):
+        merge_yaml(data, name, yaml_data, file_stat(fullname).st_mtime, template)
+    return data
+
+
+def stream_data(source_dir, csv_files, yaml_files):
+    '''Read the items of a directory without holding the csv rows in memory.
+
+    Returns data, in which each csv item only has a stub of its template and modification time,
+    and a generator of (name, item) for the complete csv items. Items are generated as soon as
+    their row is read, except those whose name repeats (or has a yaml file) which are merged in
+    a shelf on disk and generated at the end.
+    '''
+    data = {}
+    # A first pass only collects names so that the rows needing to be merged are known
+    counts = {}
+    for filename, extension in csv_files:
+        fullname = os.path.join(source_dir, f'{filename}{extension}')
+        stub = { 'template': os.path.join(source_dir, f'{filename}.html'),
+                 'modification_time': file_stat(fullname).st_mtime }
+        for name, header, row in read_csv(fullname):
+            counts[name] = counts.get(name, 0) + 1
+            if name not in data:
+                data[name] = stub
+            elif data[name] is not stub:
+                data[name] = { 'template': data[name]['template'], 'modification_time': stub['modification_time'] }
+
+    overrides = {}
+    for fullname, name, yaml_data, template in yaml_items(source_dir, yaml_files):
+        mtime = file_stat(fullname).st_mtime
+        if name in counts:
+            overrides[name] = yaml_data, mtime
+            data[name] = { 'template': data[name]['template'], 'modification_time': mtime }
+            if 'Title' not in yaml_data:
+                data[name]['Title'] = name
+        else:
+            merge_yaml(data, name, yaml_data, mtime, template)
+
+    def items():
+        with tempfile.TemporaryDirectory() as spill_dir, shelve.open(os.path.join(spill_dir, 'items')) as spill:
+            for filename, extension in csv_files:
+                fullname = os.path.join(source_dir, f'{filename}{extension}')
+                template = os.path.join(source_dir, f'{filename}.html')
+                mtime = file_stat(fullname).st_mtime
+                for name, header, row in read_csv(fullname):
+                    if counts[name] == 1 and name not in overrides:
+                        item = { 'template': template, 'modification_time': mtime, 'content': {} }
+                        merge_row(item['content'], header, row)
+                        yield name, item
+                    else:
+                        item = spill[name] if name in spill else { 'template': template, 'content': {} }
+                        item['modification_time'] = mtime
+                        merge_row(item['content'], header, row)
+                        spill[name] = item
+            for name in counts:
+                if counts[name] > 1 or name in overrides:
+                    item = spill[name]
+                    if name in overrides:
+                        merge_yaml({name: item}, name, *overrides[name])
+                    yield name, item
+
+    return data, items()
+
+
+def source_state(source_dir, destination_dir):
+    '''Return the modification time and size of every file below source_dir, by directory.'''
+    state = {}
+    for path, directories, filenames in os.walk(source_dir):
+        directories[:] = [directory for directory in directories
+                          if os.path.join(path, directory) not in [destination_dir, options['cache_dir']]]
+        files = {}
+        for filename in filenames:
             try:
-                yaml_data = yaml.safe_load(stream)
-                if name not in data:
-                    data[name] = { 'content': dict([(fix_name(key), yaml_data[key]) for key in yaml_data]) }
-                    if 'template' in yaml_data:
-                        data[name]['template'] = yaml_data['template']
-                else:
-                    for key in yaml_data:
-                        data[name]['content'][fix_name(key)] = yaml_data[key]
-                if 'Title' not in yaml_data:
-                    data[name]['Title'] = name
-                data[name]['modification_time'] = os.path.getmtime(fullname)
-            except yaml.YAMLError as exc:
-                print (exc)
+                status = os.stat(os.path.join(path, filename))
+                files[filename] = status.st_mtime_ns, status.st_size
+            except OSError:
+                pass
+        state[path] = files
+    return state
+
+
+def poll_changes(source_dir, destination_dir, interval):
+    '''Yield the set of directories with changed files every time some change.
+
+    None is yielded when directories are added or removed.
+    '''
+    state = source_state(source_dir, destination_dir)
+    while True:
+        time.sleep(interval)
+        current = source_state(source_dir, destination_dir)
+        if current.keys() != state.keys():
+            yield None
+        else:
+            changed = set([path for path in current if current[path] != state[path]])
+            if changed:
+                yield changed
+        state = current
 
+
+def inotify_changes(source_dir, destination_dir):
+    '''Yield the set of directories with changed files, as poll_changes, using inotify.'''
+    notifier = INotify()
+    mask = flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF
+    watches = {}
+    def add_watches():
+        watched = set(watches.values())
+        for path, directories, filenames in os.walk(source_dir):
+            directories[:] = [directory for directory in directories
+                              if os.path.join(path, directory) not in [destination_dir, options['cache_dir']]]
+            if path not in watched:
+                watches[notifier.add_watch(path, mask)] = path
+    add_watches()
+
+    while True:
+        changed = set()
+        restructured = False
+        for event in notifier.read(read_delay=50):     # wait a little to gather all the events of a save
+            if event.mask & flags.IGNORED:
+                watches.pop(event.wd, None)
+            elif event.mask & flags.ISDIR:
+                restructured = True
+            elif event.wd in watches:
+                changed.add(watches[event.wd])
+        if restructured:
+            add_watches()
+            yield None
+        elif changed:
+            yield changed
+
+
+def template_name(template_file):
+    '''Return the name of the items a template file is used for when they do not give one.'''
+    return os.path.splitext(os.path.basename(template_file))[0]
+
+
+directory_templates = {}     # the template files used by the pages of each source directory
+
+
+def resolve_templates(source_dir, data, template_files):
+    '''Add the name of each item to the set of names of its template in template_files.
+
+    Items without a template key use the template with the same name. Templates are looked up
+    in an index of their names and each template key is resolved to a file only once, so
+    finding the template of an item takes constant time. The templates used are recorded in
+    directory_templates, templates in other directories included.
+    '''
+    index = {}
+    for template_file in template_files:
+        index.setdefault(template_name(template_file), template_file)
+
+    resolved = {}
     for name, item in data.items():
         if 'template' in item:
-            template = os.path.normpath(item['template'])
-            if not os.path.exists(template):
-                template = os.path.normpath(os.path.join(source_dir, item['template']))
-            if os.path.exists(template):
-                if template in template_files:
-                    template_files[template].add(name)
-                else:
-                    template_files[template] = {name} 
+            if item['template'] not in resolved:
+                template = os.path.normpath(item['template'])
+                if file_stat(template) is None:
+                    template = os.path.normpath(os.path.join(source_dir, item['template']))
+                resolved[item['template']] = template, file_stat(template) is not None
+            template, found = resolved[item['template']]
+            if found:
+                if template not in template_files:
+                    template_files[template] = set()
+                    index.setdefault(template_name(template), template)
+                template_files[template].add(name)
             else:
-                log(f'Template ({template}) for {name} not found!')
-        elif name in [os.path.splitext(os.path.basename(filename))[0] for filename in template_files]:
-            template = [template for template in template_files if name == os.path.splitext(os.path.basename(template))[0]][0]
-            template_files[template].add(name)
+                logger.warning('Template (%s) for %s not found!', template, name)
+        elif name in index:
+            template_files[index[name]].add(name)
         else:
-           log(f'no template found for {name}')
-
-    meta = {
-        'directories': directories,
-        'tree': tree,
-        'images': image_files,
-        'templates': template_files,
-        'data': data
-    }
+           logger.warning('no template found for %s', name)
+    directory_templates[source_dir] = set(template_files)
 
-    for template_file, names in template_files.items():
-        with open(template_file) as file:
-            template  = file.read()
+
+def write_output(filename, text):
+    '''Write text to a file unless it already holds exactly that text.
+
+    The text is written to a temporary file which then replaces the file, so readers never
+    see a partly written page. Returns True if the file was written.
+    '''
+    with profiled('write'):
+        try:
+            with open(filename) as file:
+                if file.read() == text:
+                    return False
+        except (OSError, UnicodeDecodeError):
+            pass
+        with open(f'{filename}.tmp', 'w') as file:
+            file.write(text)
+        os.replace(f'{filename}.tmp', filename)
+        return True
+
+
+def compressors():
+    '''Return the (extension, function) of each compression of outputs the compress option writes.'''
+    methods = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        methods.append(('.br', brotli.compress))
+    return methods
+
+
+def compressed_up_to_date(filename, stat=os.stat):
+    '''Return True if every compressed copy of an output exists and was written after it.
+
+    Builds without the compress option rewrite pages without their copies, which are then older.
+    '''
+    try:
+        mtime = stat(filename).st_mtime_ns
+        for extension, compress in compressors():
+            copy = stat(f'{filename}{extension}')
+            if copy is None or copy.st_mtime_ns < mtime:
+                return False
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def compress_output(filename, text, changed=True):
+    '''Write the compressed copies of an output, unless it has not changed and they are up to date.'''
+    if not changed and compressed_up_to_date(filename):
+        return
+    data = None
+    for extension, compress in compressors():
+        compressed_file = f'{filename}{extension}'
+        if data is None:
+            data = text.encode('utf-8')
+        with profiled('compress'):
+            with open(f'{compressed_file}.tmp', 'wb') as file:
+                file.write(compress(data))
+            os.replace(f'{compressed_file}.tmp', compressed_file)
+
+
+def write_page(filename, text):
+    '''Write a page, and its compressed copies with the compress option, returning True if it changed.'''
+    changed = write_output(filename, text)
+    if options['compress']:
+        compress_output(filename, text, changed)
+    return changed
+
+
+def file_hash(filename):
+    '''Return the hash of the content of a file.'''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink(source, destination):
+    '''Clone source to destination sharing its blocks, on file systems that support it.'''
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, destination)    # as copy2 does, so later builds can compare modification times
+
+
+def sync_asset(source, destination, force):
+    '''Make destination a copy of source unless it already has the same content.
+
+    A reflink or hard link is made when the file system allows, otherwise the file is copied.
+    Returns the method used or None if destination was up to date.
+    '''
+    with profiled('assets'):
+        source_status = file_stat(source)
+        destination_status = file_stat(destination)
+        if not force and destination_status is not None:
+            if os.path.samestat(source_status, destination_status):
+                return None
+            if source_status.st_size == destination_status.st_size:
+                # Copies keep the modification time of their source, so only differing times need hashing
+                if source_status.st_mtime_ns == destination_status.st_mtime_ns:
+                    return None
+                if file_hash(source) == file_hash(destination):
+                    os.utime(destination, ns=(source_status.st_atime_ns, source_status.st_mtime_ns))
+                    return None
+
+        temporary = f'{destination}.tmp'
+        methods = [('copy', shutil.copy2)]
+        if not options['copy_assets']:
+            methods = [('reflink', reflink), ('hardlink', os.link)] + methods
+        for method, link in methods:
+            try:
+                if os.path.lexists(temporary):
+                    os.remove(temporary)
+                link(source, temporary)
+                os.replace(temporary, destination)
+                return method
+            except OSError:
+                if method == 'copy':
+                    raise
+
+
+def meta_usage():
+    '''Return, for each template rendered by the last build, how many pages read each meta key.'''
+    usage = {}
+    for key, count in stats.items():
+        if isinstance(key, tuple) and key[0] == 'meta':
+            usage.setdefault(key[1], {})[key[2]] = count
+    return usage
+
+
+def render_job(*args):
+    '''Run render_dir in a worker process, returning its result with the stats it counted.'''
+    stats.clear()
+    return render_dir(*args), stats
+
+
+def render_dir(source_dir, destination_dir, force, tree, previous={}, part=(0, 1), stream=False):
+    '''Render the pages and copy the images of a single directory.
+
+    Only the pages and images that fall in part, an (index, count) pair, are written. Pages are
+    re-rendered when any of the inputs recorded for them in previous has changed. Returns the
+    inputs of every page in part for the build manifest.
+
+    When stream is set csv items are rendered as they are read and data only holds their stubs.
+    '''
+    logger.debug('Processing directory %s', source_dir)
+
+    if not is_dir(file_entry(destination_dir)):
+        os.makedirs(destination_dir, exist_ok=True)
+        snapshots.pop(os.path.dirname(destination_dir), None)
+        logger.debug('make dir %s', destination_dir)
         
+    with profiled('list'):
+        entries = snapshot(source_dir)
+    filenames = [filename for filename in entries]
+    image_files = [file for file in filenames if os.path.splitext(file)[1].lower() in options['assets']]
+    # Templates starting with _ are layouts and partials for the others, not pages of their own
+    template_files = dict([(os.path.join(source_dir, name), set()) for name in filenames
+                            if os.path.splitext(name)[1].lower() in ['.md', '.html'] and not name.startswith('_')])
+
+    filenames.sort(key=lambda x: entries[x].stat().st_mtime)
+    content = [os.path.splitext(filename) for filename in filenames]
+    yaml_files = [file for file in content if file[1] == '.yaml']
+    csv_files = [file for file in content if file[1] == '.csv']
+    markdown_files = [file for file in content if file[1] == '.md']
+
+    if stream:
+        data, items = stream_data(source_dir, csv_files, yaml_files)
+    else:
+        data, items = load_data(source_dir, csv_files, yaml_files), []
+
+    with profiled('resolve'):
+        resolve_templates(source_dir, data, template_files)
+
+    meta = Meta({
+        'directories': lambda: [file for file, entry in entries.items() if is_dir(entry)],
+        'tree': lambda: tree,
+        'images': lambda: image_files,
+        'templates': lambda: template_files,
+        'data': lambda: data
+    })
+
+    # Markdown pages whose diagrams were all rendered by the build do without the mermaid script
+    layouts = {}
+    for static, page_boilerplate in [(False, boilerplate), (True, static_boilerplate)]:
+        if options['shared_css']:
+            root = os.path.relpath(options['destination_dir'] or destination_dir, destination_dir)
+            link = f'<link rel="stylesheet" href="{"" if root == "." else root.replace(os.sep, "/") + "/"}{style_sheet_name}">'
+            page_boilerplate = style_pattern.sub(lambda match: link, page_boilerplate)
+        layouts[static] = content_hash(page_boilerplate), split_placeholders(page_boilerplate)
+    boilerplate_hashes = [layouts[False][0]] + ([layouts[True][0]] if options['mermaid'] else [])
+
+    hashes = {}
+    def meta_hash(key):
+        if key not in hashes:
+            hashes[key] = content_hash(meta[key])
+        return hashes[key]
+
+    # Pages are written on background threads while the next ones render
+    writer = ThreadPoolExecutor(write_threads)
+    writes = collections.deque()
+    def finish_write(output_file, future):
+        if future.result():
+            stats['pages written'] += 1
+            logger.debug('Updating %s', output_file)
+        else:
+            stats['pages unchanged'] += 1
+
+    outputs = {}
+    whole = directory_shard(source_dir, destination_dir)
+    def render_page(template_file, name, item):
+        if not in_part(name, part) or not (whole or in_shard(destination_dir, f'{name}.html')):
+            return
+        template_hash, template = load_template(template_file)
+        page = f'{name}.html'
+        output_file = os.path.join(destination_dir, page)
+        markdown = os.path.splitext(template_file)[1] == '.md'
+        mdate = date.fromtimestamp(item['modification_time']).strftime('%d/%m/%Y')
+        item_hash = content_hash([item['content'], mdate])
+        inputs = previous.get(page)
+        if force or inputs is None or file_stat(output_file) is None \
+            or inputs['template'] != template_hash or inputs['item'] != item_hash \
+            or any(meta_hash(key) != inputs[key] for key in inputs if key in meta) \
+            or (markdown and inputs.get('boilerplate') not in boilerplate_hashes) \
+            or (options['mermaid'] and inputs.get('unrendered diagrams')) \
+            or (options['search'] and 'words' not in inputs) \
+            or (options['compress'] and not compressed_up_to_date(output_file, stat=file_stat)):
+            used = set()
+            values = {'%TITLE%': name, '%UPDATED%': mdate}
+            with profiled('template', template_file), profiled('item', output_file):
+                source = process(template, item['content'], meta, used, None if markdown else values)
+            for key in used:
+                stats[('meta', template_file, key)] += 1
+            if markdown:
+                content = render_markdown(source)
+                unrendered = 'class="mermaid-pre"' in content
+                boilerplate_hash, page_segments = layouts[bool(options['mermaid']) and not unrendered]
+                result = fill(page_segments, {**values, '%CONTENT%': content})
+            else:
+                result = source
+            writes.append((output_file, writer.submit(write_page, output_file, result)))
+            if len(writes) > write_queue:
+                finish_write(*writes.popleft())
+            inputs = {'template': template_hash, 'item': item_hash,
+                      **dict([(key, meta_hash(key)) for key in sorted(used)])}
+            if markdown:
+                inputs['boilerplate'] = boilerplate_hash
+                if options['mermaid'] and unrendered:
+                    inputs['unrendered diagrams'] = True    # try the diagrams again in the next build
+            if options['search']:
+                # Kept in the manifest so pages that are not re-rendered stay in the index
+                inputs['words'] = page_words(content if markdown else result)
+        else:
+            stats['pages skipped'] += 1
+        outputs[page] = inputs
+
+    for template_file, names in template_files.items():
         if len(names) > 0:
-            sources = dict([(name, data[name]) for name in names])
+            # Streamed items only have a stub in data, they are rendered as they are read below
+            sources = dict([(name, data[name]) for name in names if 'content' in data[name]])
         else:
-            mtime = os.path.getmtime(template_file)
-            name = os.path.splitext(os.path.basename(template_file))[0]
+            mtime = file_stat(template_file).st_mtime
+            name = template_name(template_file)
             sources = {name: { 'modification_time': mtime, 'content': data }}
-    
         for name, item in sources.items():
-            output_file = os.path.join(destination_dir, f'{name}.html')
-            if force or not os.path.exists(output_file) \
-                or os.path.getmtime(output_file) < item['modification_time'] \
-                or os.path.getmtime(output_file) < os.path.getmtime(template_file):
-                mdate = date.fromtimestamp(item['modification_time']).strftime('%d/%m/%Y')
-                source = process(template, item['content'], meta)
-                if os.path.splitext(template_file)[1] == '.md':
-                    content = markdown2.markdown(source, extras=extras)
-                    result = boilerplate.replace('%TITLE%', name)\
-                        .replace('%UPDATED%', mdate)\
-                        .replace('%CONTENT%', content)
-                else:
-                    result = source.replace('%TITLE%', name)\
-                        .replace('%UPDATED%', mdate)
-                log (f'Updating {output_file}')
-                with open(output_file, 'w') as file:
-                    file.write(result)
-
-    for image_file in image_files:
-        fullname = os.path.join(source_dir, image_file)
-        destination = os.path.join(destination_dir, filename)
-        log (f'Copying {fullname}')
-        if force or not os.path.exists(destination) or os.path.getmtime(destination) < os.path.getmtime(fullname):
-            shutil.copy(fullname, destination)
+            render_page(template_file, name, item)
+
+    if stream:
+        templates = dict([(name, template_file) for template_file, names in template_files.items() for name in names])
+        for name, item in items:
+            if name in templates:
+                render_page(templates[name], name, item)
+
+    while writes:
+        finish_write(*writes.popleft())
+    writer.shutdown()
+
+    assets = [(os.path.join(source_dir, image_file), os.path.join(destination_dir, image_file), force)
+              for image_file in image_files if in_part(image_file, part) and (whole or in_shard(destination_dir, image_file))]
+    if assets:
+        with ThreadPoolExecutor(asset_threads) as pool:
+            for (fullname, destination, _), method in zip(assets, pool.map(sync_asset, *zip(*assets))):
+                stats[f'assets {method or "up to date"}'] += 1
+                if method:
+                    logger.debug('Copying %s (%s)', fullname, method)
+
+    return outputs
+
+
+def shard_spec(text):
+    '''Parse the i/N of the --shard argument.'''
+    index, count = [int(number) for number in text.split('/')]
+    if not 0 <= index < count:
+        raise ValueError(text)
+    return index, count
 
-    return tree
 
 @command
 @argument('--source', default=os.getcwd(), help='directory of source files')
 @argument('--destination', default=os.path.join(os.getcwd(), 'html'), help='destination to write files to')
 @argument('--force', action='store_true', help='an optional argument')
+@argument('--cache-dir', default=default_cache_dir, help='directory to cache parsed files in, kept out of the destination')
+@argument('--jobs', type=int, default=1, help='number of processes to render with')
+@argument('--stream', action='store_true', help='render csv rows as they are read, data only holds their names')
+@argument('--markdown-cache', action='store_true', help='keep converted markdown on disk between builds')
+@argument('--assets', default='.png,.jpg', help='comma separated extensions of files to copy as they are')
+@argument('--copy-assets', action='store_true', help='copy assets rather than reflinking or hard linking them')
+@argument('--shard', type=shard_spec, default=(0, 1), help='render only the shard i of N shards of the directories, given as i/N')
+@argument('--shards', type=int, default=1, help='render as this many shards in local processes then merge them')
+@argument('--search', action='store_true', help='write a search index of every page and a script to search it')
+@argument('--compress', action='store_true', help='write .gz, and with brotli installed .br, copies of the pages that changed')
+@argument('--shared-css', action='store_true', help='link pages to one shared, content hashed stylesheet rather than inlining it')
+@argument('--mermaid', help='command to render mermaid diagrams to svg with during the build, such as a local mmdc')
+@argument('--columnar', action='store_true', help='hold csv rows as columns to save memory on wide files')
+@argument('--meta-usage', action='store_true', help='report the meta keys each template read')
+@argument('--profile', action='store_true', help='report the time spent in each stage and the slowest templates and items')
+@argument('--profile-top', type=int, default=10, help='number of the slowest templates and items to report')
+@argument('--profile-output', help='file to write cProfile statistics of the build to, for pstats')
+@argument('--quiet', action='store_true', help='only log warnings, not the summary of the build')
 def main(args):
     """ One line description here
 
     Write details here (printed with --help|-h)
     """
-    process_dir(args.source, args.destination, args.force)
+    logger.setLevel(log_level(args))
+    options['cache_dir'] = os.path.abspath(args.cache_dir)
+    options['markdown_cache'] = args.markdown_cache
+    options['assets'] = [extension.strip().lower() for extension in args.assets.split(',') if extension.strip()]
+    options['copy_assets'] = args.copy_assets
+    options['columnar'] = args.columnar
+    options['mermaid'] = args.mermaid
+    options['search'] = args.search
+    options['compress'] = args.compress
+    options['shared_css'] = args.shared_css
+    options['profile'] = args.profile
+    profiler = cProfile.Profile() if args.profile_output else None
+    if profiler:
+        profiler.enable()   # only profiles this process, not the workers started by --jobs
+    options['shard'] = args.shard
+    if args.shards > 1:
+        build_shards(args.source, args.destination, args.force, args.shards, args.jobs, args.stream)
+    else:
+        process_dir(args.source, args.destination, args.force, args.jobs, args.stream)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile_output)
+    if args.profile:
+        for line in profile_report(args.profile_top):
+            logger.info('%s', line)
+    if args.meta_usage:
+        for template, keys in sorted(meta_usage().items()):
+            logger.info('%s: %s', template, ', '.join([f'{key} ({count} pages)' for key, count in sorted(keys.items())]))
+
+
+@command.add_sub
+@argument('--source', default=os.getcwd(), help='directory of source files')
+@argument('--destination', default=os.path.join(os.getcwd(), 'html'), help='destination to write files to')
+@argument('--cache-dir', default=default_cache_dir, help='directory to cache parsed files in, kept out of the destination')
+@argument('--interval', type=float, default=0.2, help='seconds between checks when inotify is not available')
+@argument('--quiet', action='store_true', help='only log warnings, not the summary of each build')
+def watch(args):
+    """ Rebuild the pages affected by each change to the source files
+
+    Parsed data and compiled templates are kept in memory between builds. Changes are
+    detected with inotify when inotify_simple is installed, otherwise by polling.
+    """
+    logger.setLevel(log_level(args))
+    source_dir = os.path.abspath(args.source)
+    destination_dir = os.path.abspath(args.destination)
+    options['cache_dir'] = os.path.abspath(args.cache_dir)
+    options['keep_data'] = True
+    process_dir(source_dir, destination_dir, False)
+
+    if INotify is not None:
+        changes = inotify_changes(source_dir, destination_dir)
+    else:
+        changes = poll_changes(source_dir, destination_dir, args.interval)
+    logger.info('Watching %s', source_dir)
+    try:
+        for changed in changes:
+            start = time.perf_counter()
+            process_dir(source_dir, destination_dir, False, changed=changed)
+            logger.info('Rebuilt in %.3fs', time.perf_counter() - start)
+    except KeyboardInterrupt:
+        pass
+
+
+@command.add_sub
+@argument('directories', nargs='+', help='output directories of the shards')
+@argument('--destination', default=os.path.join(os.getcwd(), 'html'), help='destination to merge the shards into')
+@argument('--count', type=int, help='number of shards in the build, the number of directories by default')
+@argument('--quiet', action='store_true', help='only log warnings')
+def merge(args):
+    """ Merge the outputs of the shards of a build made with --shard i/N
+
+    Each directory is the destination of one or more shards. Their pages, assets and
+    manifests are copied into --destination, which may be one of them, and the manifests
+    are combined so later builds only render what changed.
+    """
+    logger.setLevel(log_level(args))
+    merge_shards(args.destination, args.directories, args.count or len(args.directories))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+'''Benchmark the document generator on synthetic source trees.
+
+Generates a tree of directories holding csv rows, yaml files and templates with list and
+dictionary expansions, then times cold builds, no-op incremental builds and rebuilds after
+a single file changes, along with process() and markdown2 on their own. Results are written
+as json so they can be compared between releases.
+'''
+from argtools import Command, argument
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import process_files
+
+command = Command()     # process_files has the arguments of its own command on argtools' default
+
+
+index_template = '''<html><head><title>%TITLE%</title></head>
+<body>
+    <div class="updated">%UPDATED%</div>
+    <ul>
+    [*directories: <li><a href="{key}/index.html">{key}</a></li>]
+    </ul>
+</body>
+</html>
+'''
+
+directory_template = '''<html><head><title>%TITLE%</title></head>
+<body>
+    <div class="updated">%UPDATED%</div>
+    <ul>
+    [*: <li><a href="{key}.html">{key}</a></li>]
+    </ul>
+</body>
+</html>
+'''
+
+csv_template = '''<html><head><title>%TITLE%</title></head>
+<body>
+    <div class="updated">%UPDATED%</div>
+    <h1>{Name}</h1>
+    <p>Value: {int(Value) * 2}, root: {round(sqrt(int(Value)), 2)}</p>
+    <p>{Tags}</p>
+    {#Description}
+</body>
+</html>
+'''
+
+yaml_template = '''<html><head><title>%TITLE%</title></head>
+<body>
+    <div class="updated">%UPDATED%</div>
+    <h1>{Title}</h1>
+    <ul>
+    [values: <li>{key}</li>]
+    </ul>
+    <dl>
+    [properties: <dt>{key}</dt>]
+    </dl>
+    {#notes}
+</body>
+</html>
+'''
+
+description = '''A *synthetic* description for row {row} with a [link](row{row}.html).
+
+- first point
+- second point
+
+| Column | Value |
+|--------|-------|
+| row    | {row} |
+'''
+
+
+def generate_tree(root, directories, rows, yaml_files):
+    '''Write a source tree of directories, each with a csv file of rows and yaml_files yaml files.'''
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'index.html'), 'w') as file:
+        file.write(index_template)
+    for number in range(directories):
+        path = os.path.join(root, f'directory{number}')
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'index.html'), 'w') as file:
+            file.write(directory_template)
+        with open(os.path.join(path, 'items.html'), 'w') as file:
+            file.write(csv_template)
+        with open(os.path.join(path, 'item.html'), 'w') as file:
+            file.write(yaml_template)
+        with open(os.path.join(path, 'items.csv'), 'w') as file:
+            # Tags is repeated, as Jira does for list fields
+            file.write('Name,Value,Tags,Tags,Description\n')
+            for row in range(rows):
+                text = description.format(row=row).replace('"', '""')
+                file.write(f'row{row},{row + 1},tag{row % 7},tag{row % 11},"{text}"\n')
+        for row in range(yaml_files):
+            with open(os.path.join(path, f'document{row}.yaml'), 'w') as file:
+                file.write(f'template: item.html\n'
+                           f'Title: Document {row}\n'
+                           f'values: [{", ".join(str(value) for value in range(row % 10 + 1))}]\n'
+                           f'properties: {{first: 1, second: 2, third: {row}}}\n'
+                           f'notes: |\n'
+                           f'  Notes for *document {row}*\n\n'
+                           f'  - one\n'
+                           f'  - two\n')
+
+
+def timed(function, *args, **kwargs):
+    '''Return the seconds taken to call function, discarding anything it prints.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        return time.perf_counter() - start
+
+
+def reset_caches():
+    '''Forget everything process_files holds in memory between builds.'''
+    process_files.template_cache.clear()
+    process_files.layout_cache.clear()
+    process_files.yaml_cache.clear()
+    process_files.data_cache.clear()
+    process_files.markdown_cache.clear()
+
+
+def benchmark_builds(source, destination, jobs, repeat):
+    '''Time cold, no-op and single change builds, returning the best of repeat runs of each.'''
+    results = {'cold': [], 'noop': [], 'yaml_change': [], 'csv_change': []}
+    yaml_file = os.path.join(source, 'directory0', 'document0.yaml')
+    csv_file = os.path.join(source, 'directory0', 'items.csv')
+    for run in range(repeat):
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.rmtree(process_files.options['cache_dir'], ignore_errors=True)
+        reset_caches()
+        results['cold'].append(timed(process_files.process_dir, source, destination, False, jobs))
+        reset_caches()
+        results['noop'].append(timed(process_files.process_dir, source, destination, False, jobs))
+
+        with open(yaml_file, 'a') as file:
+            file.write(f'changed: {run}\n')
+        reset_caches()
+        results['yaml_change'].append(timed(process_files.process_dir, source, destination, False, jobs))
+
+        with open(csv_file, 'a') as file:
+            # A row with a name of its own, a repeated name would merge into that item
+            file.write(f'added{run},{run + 1},tag,tag,changed\n')
+        reset_caches()
+        results['csv_change'].append(timed(process_files.process_dir, source, destination, False, jobs))
+    return dict([(name, min(times)) for name, times in results.items()])
+
+
+def benchmark_process(items, repeat):
+    '''Time rendering a template with list and dictionary expansions for items items.'''
+    data = dict([(f'row{row}', {'content': {'Name': f'row{row}'}}) for row in range(items)])
+    meta = {'directories': [], 'tree': {}, 'images': [], 'templates': {}, 'data': data}
+    template = yaml_template.replace('{#notes}', '{notes}')
+    item = {'Title': 'Title', 'values': list(range(10)), 'properties': {'a': 1, 'b': 2}, 'notes': 'notes'}
+    times = []
+    for run in range(repeat):
+        # Templates are compiled, and the meta of a directory built, once for all of its pages as in a build
+        start = time.perf_counter()
+        chunks = process_files.compile_template(template)
+        directory_meta = process_files.Meta(dict([(key, lambda value=value: value) for key, value in meta.items()]))
+        for number in range(items):
+            process_files.process(chunks, item, directory_meta)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_markdown(fragments, repeat):
+    '''Time converting fragments markdown fragments to html.'''
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        for row in range(fragments):
+            process_files.markdown2.markdown(description.format(row=row), extras=process_files.extras)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@command
+@argument('--directories', type=int, default=20, help='number of directories to generate')
+@argument('--rows', type=int, default=200, help='number of csv rows in each directory')
+@argument('--yaml', type=int, default=20, help='number of yaml files in each directory')
+@argument('--jobs', type=int, default=1, help='number of processes to build with')
+@argument('--repeat', type=int, default=3, help='number of times to run each benchmark, the best is reported')
+@argument('--output', help='file to write the json results to, printed when not given')
+@argument('--keep', help='directory to generate the tree in and keep, a temporary directory is used otherwise')
+def main(args):
+    """ Benchmark the document generator on a synthetic source tree
+
+    The tree has --directories directories each with --rows csv rows and --yaml yaml
+    files. Times are in seconds, the best of --repeat runs.
+    """
+    with tempfile.TemporaryDirectory() as temporary:
+        root = args.keep or temporary
+        source = os.path.join(root, 'source')
+        destination = os.path.join(root, 'html')
+        process_files.options['cache_dir'] = os.path.join(root, 'cache')
+        generate_tree(source, args.directories, args.rows, args.yaml)
+
+        pages = args.directories * (args.rows + args.yaml + 1) + 1
+        results = {
+            'parameters': {
+                'directories': args.directories,
+                'rows': args.rows,
+                'yaml': args.yaml,
+                'jobs': args.jobs,
+                'repeat': args.repeat,
+                'pages': pages
+            },
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'builds': benchmark_builds(source, destination, args.jobs, args.repeat),
+            'process': benchmark_process(args.rows, args.repeat),
+            'markdown': benchmark_markdown(args.rows, args.repeat)
+        }
+
+    text = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    command.run()
@@ -0,0 +1,618 @@
+'''Behaviour tests of the document generator.
+
+Builds run on copies of the fixture directories next to this file, in temporary
+directories, so the fixtures themselves are never written to. Run with python -m pytest or
+python -m unittest from the root of the repository.
+'''
+import os
+import shutil
+import sys
+import gzip
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import process_files
+
+fixtures = os.path.dirname(os.path.abspath(__file__))
+
+
+def reset_caches():
+    '''Forget everything process_files holds in memory between builds.'''
+    process_files.template_cache.clear()
+    process_files.layout_cache.clear()
+    process_files.yaml_cache.clear()
+    process_files.data_cache.clear()
+    process_files.markdown_cache.clear()
+    process_files.diagram_cache.clear()
+    process_files.directory_templates.clear()
+
+
+def read_pages(directory):
+    '''Return the text of every html page below directory by its relative path.'''
+    pages = {}
+    for path, directories, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith('.html'):
+                with open(os.path.join(path, filename)) as file:
+                    pages[os.path.relpath(os.path.join(path, filename), directory)] = file.read()
+    return pages
+
+
+class PlaceholderTest(unittest.TestCase):
+    '''%TITLE%, %UPDATED% and %CONTENT% are filled in as a page is rendered.'''
+
+    values = {'%TITLE%': 'Home', '%UPDATED%': '01/02/2024'}
+
+    def render(self, template, item={}, data={}):
+        return process_files.process(template, item, {'data': data}, values=self.values)
+
+    def test_placeholders_in_text(self):
+        self.assertEqual(self.render('<title>%TITLE%</title> %UPDATED% %OTHER% 100%'),
+                         '<title>Home</title> 01/02/2024 %OTHER% 100%')
+        self.assertEqual(process_files.process('%TITLE%', {}, {'data': {}}), '%TITLE%')
+
+    def test_placeholders_in_expansions(self):
+        self.assertEqual(self.render('[*: <li>%TITLE% {key}</li>]', data={'a': {}, 'b': {}}),
+                         '<li>Home a</li>\n<li>Home b</li>')
+        self.assertEqual(self.render('[values: {value}%UPDATED%]', {'values': [{'value': 1}]}), '101/02/2024')
+
+    def test_placeholders_in_failed_expressions(self):
+        with self.assertLogs('process_files', 'WARNING'):
+            self.assertEqual(self.render('{missing} %TITLE%'), '{missing} Home')
+        with self.assertLogs('process_files', 'WARNING'):
+            self.assertEqual(self.render('{1 +} %TITLE%'), '{1 +} Home')
+
+    def test_fill(self):
+        segments = process_files.split_placeholders('<h1>%TITLE%</h1>%CONTENT%')
+        self.assertEqual(process_files.fill(segments, {'%TITLE%': 'A', '%CONTENT%': '<p>%TITLE%</p>'}),
+                         '<h1>A</h1><p>%TITLE%</p>')
+
+
+class AggregateTest(unittest.TestCase):
+    '''The template helpers over columns of data and lists.'''
+
+    def setUp(self):
+        rows = [('Jon', '52', 'x', '0.1'), ('Zoe', '10', 'y', '0.2'), ('Ann', '  ', 'x', '0.3'), ('Cy', '', None, '')]
+        self.data = dict([(name, {'content': {'Age': age, 'Group': group, 'Share': share}})
+                          for name, age, group, share in rows])
+
+    def render(self, template, item={}):
+        return process_files.process(template, item, {'data': self.data})
+
+    def test_sum_and_mean(self):
+        self.assertEqual(self.render('{sum(data, "Age")} {mean(data, "Age")}'), '62 31.0')
+        self.assertEqual(self.render('{sum(data, "Share")} {mean(data, "Share")}'), '0.6 0.19999999999999998')
+        self.assertEqual(self.render('{sum(values)}', {'values': [1, 2]}), '3')
+        self.assertEqual(self.render('{sum(rows, "n * 2")}', {'rows': [{'n': 1}, {'n': 2}]}), '6')
+
+    def test_missing_column_warns(self):
+        for template in ['{sum(data, "Agee")}', '{sum(data, "int(Age) * 2")}', '{mean(data, "Agee")}']:
+            with self.subTest(template=template):
+                with self.assertLogs('process_files', 'WARNING') as logs:
+                    self.render(template)
+                self.assertIn('is not a column of any of the items', logs.output[0])
+
+    def test_count(self):
+        self.assertEqual(self.render('{count(data)} {count(data, "Age")} {count(data, "Group", "x")}'), '4 2 2')
+
+    def test_sort_puts_blank_values_last(self):
+        self.assertEqual(self.render('{sort(data, "Age")}'), "['Zoe', 'Jon', 'Ann', 'Cy']")
+        self.assertEqual(self.render('{sort(data, "Age", True)}'), "['Jon', 'Zoe', 'Ann', 'Cy']")
+
+    def test_group_by(self):
+        self.assertEqual(self.render('{group_by(data, "Group")}'), "{'x': ['Jon', 'Ann'], 'y': ['Zoe'], None: ['Cy']}")
+        rows = [{'n': 1, 'g': 'p'}, {'n': 2, 'g': 'q'}]
+        self.assertEqual(self.render('{group_by(rows, "g")["q"]}', {'rows': rows}), "[{'n': 2, 'g': 'q'}]")
+
+
+class BuildTest(unittest.TestCase):
+    '''Build copies of the fixtures with the options of each test.'''
+
+    def setUp(self):
+        self.options = dict(process_files.options)
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source')
+        shutil.copytree(fixtures, self.source, ignore=shutil.ignore_patterns('*.py', '__pycache__'))
+        self.destination = os.path.join(self.directory.name, 'html')
+        process_files.options['cache_dir'] = os.path.join(self.directory.name, 'cache')
+        reset_caches()
+
+    def tearDown(self):
+        process_files.options.clear()
+        process_files.options.update(self.options)
+        reset_caches()
+        self.directory.cleanup()
+
+    def build(self, destination=None, **arguments):
+        '''Build the source, returning the stats of the build.'''
+        process_files.process_dir(self.source, destination or self.destination, False, **arguments)
+        return dict(process_files.stats)
+
+    def write(self, name, text):
+        '''Write a source file, making its directory if needed.'''
+        filename = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as file:
+            file.write(text)
+
+    def edit(self, name, text):
+        '''Append text to a source file.'''
+        with open(os.path.join(self.source, name), 'a') as file:
+            file.write(text)
+
+    def read(self, name, destination=None):
+        '''Return the text of an output file.'''
+        with open(os.path.join(destination or self.destination, name)) as file:
+            return file.read()
+
+
+class SandboxTest(unittest.TestCase):
+    '''Template expressions can not reach outside of the template.'''
+
+    escapes = [
+        'Name.__class__',
+        'Name.__class__.__mro__[1].__subclasses__()',
+        '(x for x in []).gi_frame',
+        '(x for x in []).gi_frame.f_globals',
+        "'{0.__class__}'.format(Name)",
+        "'{x.__class__}'.format_map({'x': Name})",
+        'str.mro()',
+        '__import__("os")',
+        '__builtins__',
+        '(x := 1)',
+    ]
+
+    def test_escapes_do_not_compile(self):
+        for expression in self.escapes:
+            with self.subTest(expression=expression):
+                with self.assertRaises(SyntaxError):
+                    process_files.compile_expression(expression)
+
+    def test_escapes_are_left_as_text(self):
+        for expression in self.escapes:
+            with self.subTest(expression=expression):
+                template = f'<p>{{{expression}}}</p>'
+                with self.assertLogs('process_files', 'WARNING'):
+                    result = process_files.process(template, {'Name': 'Jon'}, {'data': {}})
+                self.assertEqual(result, template)
+
+    def test_builtins_are_limited(self):
+        for expression in ['open("/etc/passwd")', 'eval("1")', 'exec("1")', 'getattr(Name, "upper")', 'globals()']:
+            with self.subTest(expression=expression):
+                with self.assertLogs('process_files', 'WARNING'):
+                    result = process_files.process(f'{{{expression}}}', {'Name': 'Jon'}, {'data': {}})
+                self.assertEqual(result, f'{{{expression}}}')
+
+    def test_expressions_and_expansions(self):
+        item = {'Name': 'Jon', 'values': [1, 2]}
+        self.assertEqual(process_files.process('{Name.upper()} {len(values)}', item, {'data': {}}), 'JON 2')
+        self.assertEqual(process_files.process('[values: {value * 2}]', {'values': [{'value': 1}, {'value': 2}]},
+                                               {'data': {}}), '2\n4')
+
+
+class ManifestTest(BuildTest):
+    '''Pages are only rendered again when something they read has changed.'''
+
+    def test_no_op_build_skips_every_page(self):
+        first = self.build()
+        self.assertGreater(first['pages written'], 0)
+        second = self.build()
+        self.assertEqual(second.get('pages written', 0), 0)
+        self.assertEqual(second.get('pages unchanged', 0), 0)
+        self.assertEqual(second['pages skipped'], first['pages written'])
+
+    def test_yaml_change_renders_its_page(self):
+        self.build()
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        self.assertIn('Fish', self.read(os.path.join('mixed', 'Cheryl.html')))
+
+    def test_template_change_renders_its_pages(self):
+        first = self.build()
+        self.edit(os.path.join('csv', 'family.html'), '<p>changed</p>\n')
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 3)
+        self.assertEqual(stats['pages skipped'], first['pages written'] - 3)
+        for name in ['Jon', 'Zoe', 'Cheryl']:
+            self.assertIn('<p>changed</p>', self.read(os.path.join('csv', f'{name}.html')))
+
+    def test_data_change_renders_pages_reading_data(self):
+        self.write(os.path.join('mixed', 'total.html'), '<p>{count(data)}</p>')
+        self.build()
+        self.write(os.path.join('mixed', 'Ann.yaml'), 'Favourite Food: Soup\n')
+        with self.assertLogs('process_files', 'WARNING'):     # Ann has no template of her own
+            stats = self.build()
+        self.assertEqual(self.read(os.path.join('mixed', 'total.html')), '<p>4</p>')
+        self.assertEqual(stats['pages written'], 2)     # with the index listing data, the items are skipped
+
+    def test_missing_page_is_rendered(self):
+        self.build()
+        os.remove(os.path.join(self.destination, 'csv', 'Jon.html'))
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        self.assertTrue(os.path.exists(os.path.join(self.destination, 'csv', 'Jon.html')))
+
+    def test_lost_manifest_renders_every_page(self):
+        first = self.build()
+        os.remove(process_files.manifest_file(self.destination))
+        stats = self.build()
+        self.assertEqual(stats.get('pages skipped', 0), 0)
+        self.assertEqual(stats.get('pages written', 0) + stats.get('pages unchanged', 0), first['pages written'])
+
+
+class YamlTest(BuildTest):
+    '''Yaml files hold one item, a stream of items, or data included in other files.'''
+
+    def setUp(self):
+        super().setUp()
+        self.write(os.path.join('people', 'people.html'), '<p>{role} {team}</p>')
+        self.write(os.path.join('people', 'index.html'), '[*: {key} ]')
+        self.write(os.path.join('people', 'team.yaml'), 'name: Dev\n')
+        self.write(os.path.join('people', 'people.yaml'),
+                   'name: alice\nrole: dev\nteam: !include team.yaml\n---\nname: bob\nrole: ops\nteam: none\n'
+                   '---\nrole: anon\nteam: none\n')
+
+    def test_documents_are_items(self):
+        self.build()
+        self.assertEqual(self.read(os.path.join('people', 'alice.html')), "<p>dev {'name': 'Dev'}</p>")
+        self.assertEqual(self.read(os.path.join('people', 'bob.html')), '<p>ops none</p>')
+        self.assertEqual(self.read(os.path.join('people', 'people_2.html')), '<p>anon none</p>')
+
+    def test_included_files_are_not_items(self):
+        with self.assertNoLogs('process_files', 'WARNING'):
+            self.build()
+        self.assertEqual(self.read(os.path.join('people', 'index.html')), 'alice \nbob \npeople_2 ')
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'people', 'team.html')))
+
+    def test_underscore_files_are_items(self):
+        self.write(os.path.join('people', '_carol.yaml'), 'name: carol\nrole: qa\nteam: none\ntemplate: people.html\n')
+        self.build()
+        self.assertEqual(self.read(os.path.join('people', '_carol.html')), '<p>qa none</p>')
+
+    def test_included_file_change_renders_the_including_page(self):
+        self.build()
+        self.write(os.path.join('people', 'team.yaml'), 'name: Ops\n')
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        self.assertEqual(self.read(os.path.join('people', 'alice.html')), "<p>dev {'name': 'Ops'}</p>")
+
+    def test_include_cycle_warns(self):
+        self.write(os.path.join('people', 'loop.yaml'), 'self: !include loop.yaml\n')
+        with self.assertLogs('process_files', 'WARNING') as logs:
+            self.build()
+        self.assertIn('includes itself', '\n'.join(logs.output))
+
+
+class YamlCacheTest(BuildTest):
+    '''Parsed yaml is cached on disk, outside the destination, until the file changes.'''
+
+    def test_cache_is_kept_out_of_the_destination(self):
+        self.build()
+        self.assertTrue(os.listdir(os.path.join(process_files.options['cache_dir'], 'yaml')))
+        for path, directories, filenames in os.walk(self.destination):
+            self.assertEqual([name for name in filenames if name.endswith('.pickle')], [])
+
+    def test_cache_in_the_source_is_not_a_page_directory(self):
+        process_files.options['cache_dir'] = os.path.join(self.source, '.cache')
+        self.build()
+        self.assertTrue(os.path.exists(os.path.join(self.source, '.cache', 'yaml')))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, '.cache')))
+
+    def test_cache_is_used_by_the_next_build(self):
+        first = self.build()
+        self.assertGreater(first['yaml cache misses'], 0)
+        reset_caches()
+        second = self.build()
+        self.assertEqual(second.get('yaml cache misses', 0), 0)
+        self.assertEqual(second['yaml cache hits'], first['yaml cache misses'])
+
+    def test_changed_file_is_parsed_again(self):
+        self.build()
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        reset_caches()
+        stats = self.build()
+        self.assertEqual(stats['yaml cache misses'], 1)
+        self.assertIn('Fish', self.read(os.path.join('mixed', 'Cheryl.html')))
+
+
+class AssetTest(BuildTest):
+    '''Assets are linked or copied to the destination and only again when they change.'''
+
+    def setUp(self):
+        super().setUp()
+        self.asset = os.path.join(self.source, 'csv', 'photo.png')
+        self.output = os.path.join(self.destination, 'csv', 'photo.png')
+        with open(self.asset, 'wb') as file:
+            file.write(b'first' * 1000)
+
+    def read_output(self):
+        with open(self.output, 'rb') as file:
+            return file.read()
+
+    def test_assets_are_synced(self):
+        for copy in [False, True]:
+            with self.subTest(copy=copy):
+                process_files.options['copy_assets'] = copy
+                shutil.rmtree(self.destination, ignore_errors=True)
+                stats = self.build()
+                self.assertEqual(self.read_output(), b'first' * 1000)
+                self.assertEqual(os.path.samefile(self.asset, self.output), stats.get('assets hardlink') == 1)
+                if copy:
+                    self.assertEqual(stats['assets copy'], 1)
+
+    def test_unchanged_assets_are_not_read(self):
+        process_files.options['copy_assets'] = True
+        self.build()
+        with mock.patch.object(process_files, 'file_hash', wraps=process_files.file_hash) as file_hash:
+            stats = self.build()
+        self.assertEqual(stats['assets up to date'], 1)
+        file_hash.assert_not_called()
+
+    def test_changed_assets_are_synced_again(self):
+        process_files.options['copy_assets'] = True
+        self.build()
+        with open(self.asset, 'wb') as file:
+            file.write(b'again' * 1000)
+        stats = self.build()
+        self.assertEqual(stats['assets copy'], 1)
+        self.assertEqual(self.read_output(), b'again' * 1000)
+
+    def test_touched_assets_are_compared_by_content(self):
+        process_files.options['copy_assets'] = True
+        self.build()
+        os.utime(self.output, ns=(0, 0))
+        stats = self.build()
+        self.assertEqual(stats['assets up to date'], 1)
+        self.assertEqual(os.stat(self.output).st_mtime_ns, os.stat(self.asset).st_mtime_ns)
+
+
+class MermaidTest(BuildTest):
+    '''Mermaid diagrams are rendered by the build when a renderer is given.'''
+
+    def setUp(self):
+        super().setUp()
+        self.write(os.path.join('markdown', 'diagram.md'), 'Flow\n\n```mermaid\ngraph TD\n  A-->B\n```\n')
+        self.renderer = os.path.join(self.directory.name, 'mmdc')
+        with open(self.renderer, 'w') as file:
+            file.write(f'#!{sys.executable}\nimport sys\nopen(sys.argv[4], "w").write("<svg>diagram</svg>")\n')
+        os.chmod(self.renderer, 0o755)
+
+    def test_rendered_diagram_drops_the_script(self):
+        process_files.options['mermaid'] = self.renderer
+        self.build()
+        page = self.read(os.path.join('markdown', 'diagram.html'))
+        self.assertIn('<svg>diagram</svg>', page)
+        self.assertNotIn('cdn.jsdelivr.net', page)
+
+    def test_failed_diagram_is_tried_again(self):
+        process_files.options['mermaid'] = os.path.join(self.directory.name, 'missing')
+        with self.assertLogs('process_files', 'WARNING'):
+            self.build()
+        page = self.read(os.path.join('markdown', 'diagram.html'))
+        self.assertIn('cdn.jsdelivr.net', page)
+        self.assertIn('mermaid-pre', page)
+
+        process_files.options['mermaid'] = self.renderer
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        page = self.read(os.path.join('markdown', 'diagram.html'))
+        self.assertIn('<svg>diagram</svg>', page)
+        self.assertNotIn('cdn.jsdelivr.net', page)
+        self.assertEqual(self.build().get('pages written', 0), 0)
+
+
+class LayoutTest(BuildTest):
+    '''Templates extend layouts and include partials starting with _.'''
+
+    def setUp(self):
+        super().setUp()
+        self.write(os.path.join('layouts', '_base.html'),
+                   '<title>{block title}Site{endblock}</title>{include _nav.html}{block body}{endblock}')
+        self.write(os.path.join('layouts', '_nav.html'), '<nav>{Name}</nav>')
+        self.write(os.path.join('layouts', 'page.html'), '{extends _base.html}{block body}<p>{Role}</p>{endblock}')
+        self.write(os.path.join('layouts', 'page.yaml'), 'Name: Jon\nRole: Dad\n')
+
+    def test_layout_blocks_and_partials(self):
+        self.build()
+        self.assertEqual(self.read(os.path.join('layouts', 'page.html')), '<title>Site</title><nav>Jon</nav><p>Dad</p>')
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'layouts', '_base.html')))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'layouts', '_nav.html')))
+
+    def test_layout_change_renders_pages(self):
+        self.build()
+        self.edit(os.path.join('layouts', '_nav.html'), '<hr>')
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        self.assertEqual(self.read(os.path.join('layouts', 'page.html')),
+                         '<title>Site</title><nav>Jon</nav><hr><p>Dad</p>')
+
+    def test_watch_rebuilds_users_of_changed_templates(self):
+        self.write(os.path.join('shared', 'card.html'), '<p>{Name}</p>')
+        self.write(os.path.join('cards', 'card.yaml'), 'Name: Jon\ntemplate: ../shared/card.html\n')
+        self.build()
+        self.assertEqual(self.read(os.path.join('cards', 'card.html')), '<p>Jon</p>')
+        self.write(os.path.join('shared', 'card.html'), '<div>{Name}</div>')
+        process_files.process_dir(self.source, self.destination, False, changed={os.path.join(self.source, 'shared')})
+        self.assertEqual(self.read(os.path.join('cards', 'card.html')), '<div>Jon</div>')
+        self.write(os.path.join('layouts', '_nav.html'), '<nav>{Role}</nav>')
+        process_files.process_dir(self.source, self.destination, False, changed={os.path.join(self.source, 'layouts')})
+        self.assertEqual(self.read(os.path.join('layouts', 'page.html')), '<title>Site</title><nav>Dad</nav><p>Dad</p>')
+
+
+class OutputTest(BuildTest):
+    '''The ways of holding the data all write the same pages.'''
+
+    def setUp(self):
+        super().setUp()
+        self.write(os.path.join('columns', 'people.csv'), 'Name,Age,table,x\nJon,52,a,1\nZoe,10,,2\nAnn,,b,1\n')
+        self.write(os.path.join('columns', 'people.html'), '<p>{Name} {Age}</p>')
+        self.write(os.path.join('columns', 'index.html'),
+                   '<p>{count(data, "table")} {group_by(data, "x")} {sort(data, "Age")} {sum(data, "Age")}</p>')
+        self.build()
+        self.expected = read_pages(self.destination)
+
+    def test_jobs(self):
+        reset_caches()
+        destination = os.path.join(self.directory.name, 'jobs')
+        self.build(destination, jobs=3)
+        self.assertEqual(read_pages(destination), self.expected)
+
+    def test_jobs_splitting_directories(self):
+        reset_caches()
+        split_size = process_files.split_size
+        process_files.split_size = 16   # every directory with data has its pages spread over the jobs
+        try:
+            destination = os.path.join(self.directory.name, 'split')
+            self.build(destination, jobs=3)
+        finally:
+            process_files.split_size = split_size
+        self.assertEqual(read_pages(destination), self.expected)
+        self.assertEqual(process_files.load_manifest(destination), process_files.load_manifest(self.destination))
+
+    def test_stream(self):
+        reset_caches()
+        destination = os.path.join(self.directory.name, 'stream')
+        with self.assertLogs('process_files', 'WARNING') as logs:
+            self.build(destination, stream=True)
+        self.assertIn('Age is missing from the csv items of data with --stream', '\n'.join(logs.output))
+        pages = read_pages(destination)
+        index = os.path.join('columns', 'index.html')
+        self.assertNotEqual(pages.pop(index), self.expected.pop(index))     # helpers only see the stubs
+        self.assertEqual(pages, self.expected)
+
+    def test_columnar(self):
+        reset_caches()
+        process_files.options['columnar'] = True
+        destination = os.path.join(self.directory.name, 'columnar')
+        self.build(destination)
+        self.assertEqual(read_pages(destination), self.expected)
+        self.assertEqual(self.read(os.path.join('columns', 'index.html'), destination),
+                         "<p>2 {'1': ['Jon', 'Ann'], '2': ['Zoe']} ['Zoe', 'Jon', 'Ann'] 62</p>")
+
+
+class ShardTest(BuildTest):
+    '''Sharded builds, merged, write the same pages as a whole build.'''
+
+    def setUp(self):
+        super().setUp()
+        self.build()
+        self.expected = read_pages(self.destination)
+
+    def manifests(self, destination):
+        return sorted([name for name in os.listdir(destination) if name.startswith(process_files.manifest_name)])
+
+    def test_local_shards(self):
+        reset_caches()
+        destination = os.path.join(self.directory.name, 'shards')
+        process_files.build_shards(self.source, destination, False, 3)
+        self.assertEqual(read_pages(destination), self.expected)
+        self.assertEqual(self.manifests(destination), [process_files.manifest_name])
+
+    def test_merged_nodes(self):
+        shard_dirs = [os.path.join(self.directory.name, f'node{index}') for index in range(3)]
+        for index, shard_dir in enumerate(shard_dirs):
+            reset_caches()
+            process_files.options['shard'] = (index, 3)
+            self.build(shard_dir)
+        process_files.options['shard'] = (0, 1)
+        destination = os.path.join(self.directory.name, 'merged')
+        process_files.merge_shards(destination, shard_dirs, 3)
+        self.assertEqual(read_pages(destination), self.expected)
+        self.assertEqual(self.manifests(destination), [process_files.manifest_name])
+
+    def test_whole_build_between_sharded_builds(self):
+        page = os.path.join('mixed', 'Cheryl.html')
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        process_files.build_shards(self.source, self.destination, False, 2)
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Chips\n')
+        self.build()
+        self.assertIn('Chips', self.read(page))
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        process_files.build_shards(self.source, self.destination, False, 2)
+        self.assertIn('Fish', self.read(page))
+
+
+class SearchTest(BuildTest):
+    '''The search index lists the pages holding each word.'''
+
+    def setUp(self):
+        super().setUp()
+        process_files.options['search'] = True
+
+    def search(self, word, destination=None):
+        '''Return the pages with word, looked up in the trie of the index as the search script does.'''
+        with gzip.open(os.path.join(destination or self.destination, process_files.search_index_name)) as file:
+            index = json.load(file)
+        node = index['trie']
+        for character in word:
+            node = node.get(character, {})
+        return [index['pages'][page] for page in index['postings'][node['$']]] if '$' in node else []
+
+    def test_index_lists_pages(self):
+        self.build()
+        self.assertEqual(self.search('pavlova'), ['csv/Cheryl.html'])
+        self.assertEqual(self.search('roast'), ['mixed/Cheryl.html'])     # from the yaml file of the item
+        self.assertEqual(self.search('curry'), ['csv/Jon.html', 'mixed/Jon.html'])
+        self.assertEqual(self.search('sticky'), [])     # the text of the page, not its style
+        self.assertTrue(os.path.exists(os.path.join(self.destination, process_files.search_script_name)))
+
+    def test_skipped_pages_stay_in_the_index(self):
+        self.build()
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        stats = self.build()
+        self.assertEqual(stats['pages written'], 1)
+        self.assertEqual(self.search('roast'), [])
+        self.assertEqual(self.search('fish'), ['mixed/Cheryl.html'])
+        self.assertEqual(self.search('curry'), ['csv/Jon.html', 'mixed/Jon.html'])
+
+    def test_merged_shards_have_the_whole_index(self):
+        self.build()
+        destination = os.path.join(self.directory.name, 'shards')
+        process_files.build_shards(self.source, destination, False, 3)
+        for word in ['pavlova', 'curry', 'tacos']:
+            self.assertEqual(self.search(word, destination), self.search(word))
+
+
+class CompressTest(BuildTest):
+    '''Pages have compressed copies next to them that are kept up to date.'''
+
+    def setUp(self):
+        super().setUp()
+        process_files.options['compress'] = True
+        self.page = os.path.join(self.destination, 'mixed', 'Cheryl.html')
+
+    def compressed(self):
+        with gzip.open(f'{self.page}.gz', 'rt') as file:
+            return file.read()
+
+    def test_pages_are_compressed(self):
+        self.build()
+        for name, text in read_pages(self.destination).items():
+            with gzip.open(os.path.join(self.destination, f'{name}.gz'), 'rt') as file:
+                self.assertEqual(file.read(), text)
+
+    def test_unchanged_pages_are_not_compressed_again(self):
+        self.build()
+        modified = os.stat(f'{self.page}.gz').st_mtime_ns
+        stats = self.build()
+        self.assertEqual(stats.get('pages written', 0), 0)
+        self.assertEqual(os.stat(f'{self.page}.gz').st_mtime_ns, modified)
+
+    def test_out_of_date_copies_are_rewritten(self):
+        self.build()
+        process_files.options['compress'] = False
+        self.write(os.path.join('mixed', 'Cheryl.yaml'), 'Favourite Food: Fish\n')
+        self.build()
+        self.assertNotIn('Fish', self.compressed())
+        process_files.options['compress'] = True
+        self.build()
+        self.assertIn('Fish', self.compressed())
+        self.assertEqual(self.compressed(), self.read(self.page))
+
+
+if __name__ == '__main__':
+    unittest.main()